@@ -1,62 +1,19 @@
 import datetime
-import folium
 import pandas as pd
 import geopandas as gpd
-import ipywidgets as widgets
-import plotly.graph_objects as go
-import plotly.io as pio
 from shapely.geometry import Point
+from netatmo_storage import read_netatmo
+from netatmo_cleaning import remove_unreliable_stations
+from netatmo_rollups import monthly_statistics, rollup_view, window_statistics, station_columns
+from station_registry import station_key, attach_metadata
 
 
 #////////////////////////////////////////////////////////////////////////////////////////////////////////
 
-def remove_unreliable_stations(temp_net_df, temp_net_cleaned, netatmo_out_path, year, month):
-    columns = ['module_id', 'device_id', 'lat', 'long', 'timezone', 'country', 'altitude',
-               'city', 'street', 'geometry']
-
-    df1_n_obs = temp_net_df.groupby('module_id').size().reset_index(name='n.obs(original)')
-    df1 = pd.merge(df1_n_obs, temp_net_df.drop_duplicates('module_id')[columns], on='module_id', how='left')
-    
-    df2_n_obs = temp_net_cleaned.groupby('module_id').size().reset_index(name='n.obs(cleaned)')
-    df2 = pd.merge(df2_n_obs, temp_net_cleaned.drop_duplicates('module_id')[columns], on='module_id', how='left')
-    
-    # First, merge only the specified column from df1 to df2 based on the common key 'module_id'
-    merged_columns = pd.merge(df1[['module_id','n.obs(original)']], df2[['module_id']], on='module_id', how='left')
-    
-    # Merge the merged_column back to df2 based on the common key 'module_id'
-    reliability_df = pd.merge(df2, merged_columns, on='module_id', how='left')
-    
-    reliability_df['n.obs(removed)'] = reliability_df['n.obs(original)']-reliability_df['n.obs(cleaned)']
-    reliability_df['(r_percentage)'] = reliability_df['n.obs(removed)']/reliability_df['n.obs(original)']
-    reliability_df['sens_reliability'] = reliability_df['n.obs(cleaned)'] / reliability_df['n.obs(original)']
-    reliability_df = reliability_df.fillna(0)
-    
-    # Reorder the columns
-    reliability_df = reliability_df[['module_id', 'n.obs(original)', 'n.obs(cleaned)', 'n.obs(removed)', '(r_percentage)',
-                                     'sens_reliability', 'device_id', 'lat', 'long', 'timezone', 'country', 'altitude', 'city', 
-                                     'street', 'geometry']]
-    
-    # Filter df1 based on sens_reliability
-    filtered_stations = reliability_df[reliability_df['sens_reliability'] >= 0.5]
-    removed_stations = reliability_df[reliability_df['sens_reliability'] <= 0.5]
-    filtered_stations.reset_index(drop=True, inplace=True)
-    removed_stations.reset_index(drop=True, inplace=True)
-    
-    # Get the list of module IDs with reliability >= 0.5
-    reliable_stations = filtered_stations['module_id'].tolist()
-    
-    # Filter df2 based on reliable_module_ids
-    temp_net_filtered = temp_net_cleaned[temp_net_cleaned['module_id'].isin(reliable_stations)]
-    temp_net_filtered.reset_index(drop=True, inplace=True)
-    
-    #temp_net_filtered.to_csv(netatmo_out_path + 'temp_Net_milan_%s-%s_filtered.csv' % (year, month), index=False)
-    #reliability_df.to_csv(netatmo_out_path + 'Reliability_Index/stations_reliability_%s-%s.csv' % (year, month), index=False)
-    
-    return reliability_df, filtered_stations, removed_stations, temp_net_filtered
-
 #////////////////////////////////////////////////////////////////////////////////////////////////////////
 
 def plot_stations_reliability_map(selected_df, aoi_filepath='CMM.gpkg'):
+    import folium
     
     try:
         aoi_gdf = gpd.read_file(aoi_filepath)
@@ -130,301 +87,97 @@ def plot_stations_reliability_map(selected_df, aoi_filepath='CMM.gpkg'):
 # the (min, max, mean, median, std) values of that month
 #////////////////////////////////////////////////////////////////////////////////////////////////////////
 
-def resample_df_daily(folder_path,year,month,file_type):
-    # Read the CSV file
-    files_path = (folder_path + f'temp_Net_milan_{year}-{month}_{file_type}.csv')
-    df = pd.read_csv(files_path)
+def resample_df_daily(folder_path,year,month,file_type,registry=None):
+    # Read the file (Parquet if available, otherwise CSV)
+    df = read_netatmo(folder_path, year, month, file_type, categorical=False)
+    key = station_key(df)
     
-    # Extract relevant columns for sensors
-    df1 = df[["device_id", "module_id", "lat", "long", "timezone", "country", "altitude", "city", "street", "geometry"]].drop_duplicates(subset="module_id", keep="first")
+    # Extract relevant columns for sensors (only the station_id in the observation tables)
+    df1 = df[station_columns(df)].drop_duplicates(subset=key, keep="first")
     
-    # Convert 'time' column to datetime and set it as the index
-    df['time'] = pd.to_datetime(df['time'])
-    df.set_index('time', inplace=True)
-    
-    # Group by module_id and date
-    grouped = df.groupby(['module_id', df.index.date])
-
-    # Resample temperature data
-    daily_min_temp = grouped['Temperature'].resample('D').min()
-    daily_max_temp = grouped['Temperature'].resample('D').max()
-    daily_mean_temp = grouped['Temperature'].resample('D').mean()
-    daily_median_temp = grouped['Temperature'].resample('D').median()
-    daily_std_temp = grouped['Temperature'].resample('D').std()
-
-    # Create a DataFrame with daily temperature statistics
-    df2 = pd.DataFrame({
-        'Min_Temp': daily_min_temp,
-        'Mean': daily_mean_temp,
-        'Median': daily_median_temp,
-        'Max_Temp': daily_max_temp,
-        'Std': daily_std_temp
-    })
+    # Day of every measure (the time parsed once)
+    day = pd.to_datetime(df['time'], format='ISO8601').dt.floor('D').rename('time')
+
+    # All the daily temperature statistics of every station in one pass
+    df2 = df['Temperature'].groupby([df[key], day]).agg(['min', 'mean', 'median', 'max', 'std'])
+    df2.columns = ['Min_Temp', 'Mean', 'Median', 'Max_Temp', 'Std']
     df2.reset_index(inplace=True)
-    df2.drop(columns=['level_1'], inplace=True)
 
     # Merge the DataFrames based on the common key column
-    daily_stat = pd.merge(df2, df1, on='module_id', how='inner')
+    daily_stat = pd.merge(df2, df1, on=key, how='inner')
 
     # Reorder the columns
     daily_stat = daily_stat[['time', 'Min_Temp', 'Mean', 
-                           'Median', 'Max_Temp', 'Std', 'device_id','module_id', 
-                            'lat', 'long', 'timezone', 'country', 'altitude', 
-                           'city', 'street', 'geometry']]
+                           'Median', 'Max_Temp', 'Std'] + list(df1.columns)]
     
-    # Create 'geometry' column as Point objects
-    geometry_array = [Point(xy) for xy in zip(daily_stat['long'], daily_stat['lat'])]
-    # Create a GeoDataFrame
-    daily_stat_gdf = gpd.GeoDataFrame(daily_stat, geometry=geometry_array, crs='EPSG:4326')
-    
-    # Convert time column to string
-    daily_stat_gdf['time'] = daily_stat_gdf['time'].astype(str)
-
-    return daily_stat_gdf
+    return _statistics_gdf(daily_stat, registry)
     
 #////////////////////////////////////////////////////////////////////////////////////////////////////////
 # this function resamples the temperature column MONTHLY returning
 # the (min, max, mean, median, std) values of that month
 #////////////////////////////////////////////////////////////////////////////////////////////////////////
 
-def resample_df_montly(folder_path,year,month,file_type):
-    # Read the CSV file
-    files_path = (folder_path + f'temp_Net_milan_{year}-{month}_{file_type}.csv')
-    df = pd.read_csv(files_path)
+def resample_df_montly(folder_path,year,month,file_type,registry=None):
+    # Read the file (Parquet if available, otherwise CSV)
+    df = read_netatmo(folder_path, year, month, file_type, categorical=False)
     
-    # Extract relevant columns for sensors
-    df1 = df[["device_id", "module_id", "lat", "long", "timezone", "country", "altitude", "city","street","geometry"]].drop_duplicates(subset="module_id", keep="first")
-    
-    # Convert 'time' column to datetime and set it as the index
-    df['time'] = pd.to_datetime(df['time'])
-    df.set_index('time', inplace=True)
-    
-    # Group by module_id and date
-    grouped = df.groupby(['module_id', pd.Grouper(freq='M')])
-
-    # Resample temperature data
-    monthly_min_temp = grouped['Temperature'].min()
-    monthly_max_temp = grouped['Temperature'].max()
-    monthly_mean_temp = grouped['Temperature'].mean()
-    monthly_median_temp = grouped['Temperature'].median()
-    monthly_std_temp = grouped['Temperature'].std()
-
-    # Create a DataFrame with montly temperature statistics
-    df2 = pd.DataFrame({
-        'Min_Temp': monthly_min_temp,
-        'Mean': monthly_mean_temp,
-        'Median': monthly_median_temp,
-        'Max_Temp': monthly_max_temp,
-        'Std': monthly_std_temp
-    })
-    df2.reset_index(inplace=True)
-    #df2.drop(columns=['level_1'], inplace=True)
-
-    # Merge the DataFrames based on the common key column
-    monthly_stat = pd.merge(df2, df1, on='module_id', how='inner')
-
-    # Reorder the columns
-    monthly_stat = monthly_stat[['time', 'Min_Temp', 'Mean', 
-                           'Median', 'Max_Temp', 'Std', 'device_id','module_id', 
-                            'lat', 'long', 'timezone', 'country', 'altitude', 
-                           'city', 'street', 'geometry']]
-        
-    # Create 'geometry' column as Point objects
-    geometry_array = [Point(xy) for xy in zip(monthly_stat['long'], monthly_stat['lat'])]
-    # Create a GeoDataFrame
-    monthly_stat_gdf = gpd.GeoDataFrame(monthly_stat, geometry=geometry_array, crs='EPSG:4326')
-    
-    # Convert time column to string
-    monthly_stat_gdf['time'] = monthly_stat_gdf['time'].astype(str)
+    # Monthly temperature statistics of every module_id in one pass, with the data of the station
+    monthly_stat = monthly_statistics(df)
 
-    return monthly_stat_gdf
+    return _statistics_gdf(monthly_stat, registry)
 
 #////////////////////////////////////////////////////////////////////////////////////////////////////////
-# this function resamples the temperature column MONTHLY concatenate all the monthly resampled dfs 
-# returning the (min, max, mean, median, std) values of every month during the year
+# this function returns the (min, max, mean, median, std) values of every month during the year,
+# composed from the monthly statistics cached in folder_path/rollups (see netatmo_rollups)
 #////////////////////////////////////////////////////////////////////////////////////////////////////////
 
-def resample_df_annually(folder_path,year,file_type):
-    
-    ##Step_1: concatenate the montly_statistics data-frames to a single data frame df1
-    # Create an empty DataFrame to store the resampled dataframes monthly
-    dfs=[]
-
-    if year == 2023:
-        months = range(1, 10)  # January to September
-    else:
-        months = range(1, 13)  # All months
+def resample_df_annually(folder_path,year,file_type,cache_path=None,registry=None):
     
-    for month in months:
-        df = resample_df_montly(folder_path,year,month,file_type)
-        globals()[f"df_{month}"] = df
-        dfs.append(df)
-        df1 = pd.concat(dfs, ignore_index=True)
+    # One row for every Netatmo station and every month of the year (NaN for the months without data)
+    annual_stat = rollup_view(folder_path, [(year, month) for month in range(1, 13)], file_type, cache_path)
 
-    ##Step_2: create df2 filling the missing time gaps for all Netatmo stations
-    
-    columns = ['module_id','time', 'device_id', 'lat', 'long', 'timezone', 
-               'country', 'altitude', 'city', 'street', 'geometry']
-    df2 = pd.DataFrame(columns=columns)
+    return _statistics_gdf(annual_stat, registry)
 
-    for month in months:
-        df = globals()[f'df_{month}']
-        df2 = pd.concat([df2, df[columns]], ignore_index=True)
-
-    df2.drop_duplicates(subset='module_id', inplace=True)
-    
-    # Create a list of dates for each module_id
-    dates = pd.date_range(start=f'{year}-01-31', end=f'{year}-12-31', freq='ME')
-    dates = dates.strftime('%Y-%m-%d').tolist()  # Convert dates to string format
-    
-    # Create a dictionary to map module_id to dates
-    dates_dict = {module_id: dates for module_id in df2['module_id'].unique()}
-    
-    # Create a new column 'time' and populate it with the corresponding dates
-    df2['time'] = df2['module_id'].map(dates_dict)
-    
-    # Explode the 'time' column to separate rows for each date
-    df2 = df2.explode('time')
-    
-    # Reset index
-    df2.reset_index(drop=True, inplace=True)
-
-    ##Step_3: Merge df1 and df2
-    #perform a left join between the first dataframe (which contains all the rows) and the second dataframe
-    #(which contains the temperature statistics).
-    #This will ensure that all rows from the first dataframe are included in the final result,
-    #and missing values in the second dataframe will be filled with NaN.
-    
-    
-    # Convert 'time' column to datetime type in both dataframes
-    if file_type == 'clip':
-        df1['time'] = pd.to_datetime(df1['time']).dt.tz_localize(None)
-    else:
-       df1['time'] = pd.to_datetime(df1['time'])
-    
-    df2['time'] = pd.to_datetime(df2['time'])
-    
-    #perform a left join on 'module_id' and 'time' between the two dataframes with specified columns to merge.
-    annual_stat = pd.merge(df2, df1[['module_id', 'time', 'Min_Temp', 'Mean', 
-                                   'Median', 'Max_Temp', 'Std']], on=['module_id', 'time'], how='left')
+#////////////////////////////////////////////////////////////////////////////////////////////////////////
+# this function resamples the temperature column seasonly  returning
+# the (min, max, mean, median, std) values of June, July, and August
+#////////////////////////////////////////////////////////////////////////////////////////////////////////
 
-    # Sort the dataframe by 'module_id' and 'time' for better readability
-    annual_stat.sort_values(by=['module_id', 'time'], inplace=True)
-    
-    # Forward fill missing values for temperature statistics within each 'module_id'
-    annual_stat[['Min_Temp', 'Mean', 'Median', 'Max_Temp', 'Std']] = annual_stat[['Min_Temp', 'Mean', 'Median', 'Max_Temp', 'Std']].fillna(0)
-    
-    #drop duplicate rows to keep only the unique rows in the final dataframe.
-    annual_stat.drop_duplicates(subset=['module_id', 'time'], inplace=True)
-    
-    # Reorder the columns
-    annual_stat = annual_stat[['time', 'Min_Temp', 'Mean', 
-                           'Median', 'Max_Temp', 'Std', 'device_id','module_id',  
-                           'lat', 'long', 'timezone', 'country', 'altitude', 
-                           'city', 'street', 'geometry']]
+def resample_df_seasonly(folder_path,year,file_type,cache_path=None,registry=None):
     
-    # Create 'geometry' column as Point objects
-    geometry_array = [Point(xy) for xy in zip(annual_stat['long'], annual_stat['lat'])]
-    # Create a GeoDataFrame
-    annual_stat_gdf = gpd.GeoDataFrame(annual_stat, geometry=geometry_array, crs='EPSG:4326')
-    
-    # Convert time column to string
-    annual_stat_gdf['time'] = annual_stat_gdf['time'].astype(str)
+    # One row for every Netatmo station and every summer month (NaN for the months without data)
+    summer_stat = rollup_view(folder_path, [(year, month) for month in range(6, 9)], file_type, cache_path)
 
-    
-    return annual_stat_gdf
+    return _statistics_gdf(summer_stat, registry)
 
 #////////////////////////////////////////////////////////////////////////////////////////////////////////
-# this function resamples the temperature column seasonly  returning
-# the (min, max, mean, median, std) values of June, July, and August
+# this function returns the (min, max, mean, median, std) values of every station over several months
+# (a list of (year, month), e.g. a whole year), merged from the cached monthly partial statistics
+# without reading the measures again (see netatmo_rollups.window_statistics)
 #////////////////////////////////////////////////////////////////////////////////////////////////////////
 
-def resample_df_seasonly(folder_path,year,file_type):
-    
-    ##Step_1: concatenate the montly_statistics data-frames to a single data frame df1
-    
-    # Create an empty DataFrame to store the monthly resampled dataframes
-    dfs=[]
-    
-    for month in range(6, 9):
-        df = resample_df_montly(folder_path,year,month,file_type)
-        globals()[f"df_{month}"] = df
-        dfs.append(df)
-        df1 = pd.concat(dfs, ignore_index=True)
+def resample_df_period(folder_path,periods,file_type,cache_path=None,percentiles=(),registry=None):
 
-    ##Step_2: create df2 filling the missing time gaps for all Netatmo stations
-    
-    columns = ['module_id','time', 'device_id', 'lat', 'long', 'timezone', 
-               'country', 'altitude', 'city', 'street', 'geometry']
-    df2 = pd.DataFrame(columns=columns)
+    period_stat = window_statistics(folder_path, periods, file_type, cache_path, percentiles)
 
-    for month in range(6, 9):
-        df = globals()[f'df_{month}']
-        df2 = pd.concat([df2, df[columns]], ignore_index=True)
+    return _statistics_gdf(period_stat, registry)
 
-    df2.drop_duplicates(subset='module_id', inplace=True)
-    
-    # Create a list of dates for each module_id
-    dates = pd.date_range(start=f'{year}-06-30', end=f'{year}-08-31', freq='ME')
-    dates = dates.strftime('%Y-%m-%d').tolist()  # Convert dates to string format
-    
-    # Create a dictionary to map module_id to dates
-    dates_dict = {module_id: dates for module_id in df2['module_id'].unique()}
-    
-    # Create a new column 'time' and populate it with the corresponding dates
-    df2['time'] = df2['module_id'].map(dates_dict)
-    
-    # Explode the 'time' column to separate rows for each date
-    df2 = df2.explode('time')
-    
-    # Reset index
-    df2.reset_index(drop=True, inplace=True)
-
-    ##Step_3: Merge df1 and df2
-    #perform a left join between the first dataframe (which contains all the rows) and the second dataframe
-    #(which contains the temperature statistics).
-    #This will ensure that all rows from the first dataframe are included in the final result,
-    #and missing values in the second dataframe will be filled with NaN.
-    
-    
-    # Convert 'time' column to datetime type in both dataframes
-    if file_type == 'clip':
-        df1['time'] = pd.to_datetime(df1['time']).dt.tz_localize(None)
-    else:
-        df1['time'] = pd.to_datetime(df1['time'])
+#////////////////////////////////////////////////////////////////////////////////////////////////////////
 
-    
-    df2['time'] = pd.to_datetime(df2['time'])
-    
-    #perform a left join on 'module_id' and 'time' between the two dataframes with specified columns to merge.
-    summer_stat = pd.merge(df2, df1[['module_id', 'time', 'Min_Temp', 'Mean', 
-                                   'Median', 'Max_Temp', 'Std']], on=['module_id', 'time'], how='left')
+def _statistics_gdf(stat, registry=None):
+    # The observation tables (see station_registry) have only the station_id: join the data of the
+    # stations from the registry (load_station_registry)
+    if registry is not None and 'station_id' in stat.columns:
+        stat = attach_metadata(stat, registry, [column for column in station_columns(registry)
+                                                if column not in stat.columns])
 
-    # Sort the dataframe by 'module_id' and 'time' for better readability
-    summer_stat.sort_values(by=['module_id', 'time'], inplace=True)
-    
-    # Forward fill missing values for temperature statistics within each 'module_id'
-    summer_stat[['Min_Temp', 'Mean', 'Median', 'Max_Temp', 'Std']] = summer_stat[['Min_Temp', 'Mean', 'Median', 'Max_Temp', 'Std']].fillna(0)
-    
-    #drop duplicate rows to keep only the unique rows in the final dataframe.
-    summer_stat.drop_duplicates(subset=['module_id', 'time'], inplace=True)
-    
-    # Reorder the columns
-    summer_stat = summer_stat[['time', 'Min_Temp', 'Mean', 
-                           'Median', 'Max_Temp', 'Std', 'device_id', 'module_id',  
-                           'lat', 'long', 'timezone', 'country', 'altitude', 
-                           'city', 'street', 'geometry']]
-    
-    # Create 'geometry' column as Point objects
-    geometry_array = [Point(xy) for xy in zip(summer_stat['long'], summer_stat['lat'])]
-    # Create a GeoDataFrame
-    summer_stat_gdf = gpd.GeoDataFrame(summer_stat, geometry=geometry_array, crs='EPSG:4326')
+    # Create a GeoDataFrame with the 'geometry' column as Point objects
+    stat_gdf = gpd.GeoDataFrame(stat, geometry=gpd.points_from_xy(stat['long'], stat['lat']), crs='EPSG:4326')
     
     # Convert time column to string
-    summer_stat_gdf['time'] = summer_stat_gdf['time'].astype(str)
+    stat_gdf['time'] = stat_gdf['time'].astype(str)
 
-    
-    return summer_stat_gdf
+    return stat_gdf
 
 ##################################################################################################################
 ##################################################################################################################
@@ -435,6 +188,7 @@ def resample_df_seasonly(folder_path,year,file_type):
 #////////////////////////////////////////////////////////////////////////////////////////////////////////
 
 def create_date_dropdown(dataframe):
+    import ipywidgets as widgets
     # Group by 'time' column
     dates = dataframe.groupby('time')
 
@@ -457,6 +211,7 @@ def create_date_dropdown(dataframe):
 #////////////////////////////////////////////////////////////////////////////////////////////////////////
 
 def create_sensors_dropdown(dataframe):
+    import ipywidgets as widgets
     # Group by 'module_id' column
     sensors = dataframe.groupby('module_id')
     # Create separate DataFrames for each station
@@ -481,6 +236,7 @@ def create_sensors_dropdown(dataframe):
 #////////////////////////////////////////////////////////////////////////////////////////////////////////
 
 def plot_median_temp_map(selected_gdf):
+    import folium
     # Create 'geometry' column as Point objects
     #geometry_array = [Point(xy) for xy in zip(selected_df['long'], selected_df['lat'])]
     # Create a GeoDataFrame
@@ -524,6 +280,7 @@ def plot_median_temp_map(selected_gdf):
 #////////////////////////////////////////////////////////////////////////////////////////////////////////
    
 def plot_daily_statistics(df, date_dropdown):
+    import plotly.graph_objects as go
     # Convert the data to plotly format
     fig = go.Figure()
     
@@ -571,6 +328,7 @@ def plot_daily_statistics(df, date_dropdown):
 #////////////////////////////////////////////////////////////////////////////////////////////////////////
 
 def plot_montly_statistics(df,month,year):
+    import plotly.graph_objects as go
     # Convert the data to plotly format
     fig = go.Figure()
     
@@ -618,6 +376,7 @@ def plot_montly_statistics(df,month,year):
 #////////////////////////////////////////////////////////////////////////////////////////////////////////
 
 def plot_time_series_m(df, sensor_dropdown, month, year):
+    import plotly.graph_objects as go
     # Convert the data to plotly format
     fig = go.Figure()
     
@@ -665,6 +424,7 @@ def plot_time_series_m(df, sensor_dropdown, month, year):
 #////////////////////////////////////////////////////////////////////////////////////////////////////////
 
 def plot_time_series(df, sensor_dropdown, year):
+    import plotly.graph_objects as go
     # Convert the data to plotly format
     fig = go.Figure()
     
@@ -710,11 +470,11 @@ def plot_time_series(df, sensor_dropdown, year):
 # this function plots a histogram of the median temperature
 #////////////////////////////////////////////////////////////////////////////////////////////////////////     
 
-import seaborn as sns
-import matplotlib.pyplot as plt
 import calendar
 
 def plot_histogram_clip(df, month, year):
+    import seaborn as sns
+    import matplotlib.pyplot as plt
     # Assuming month and year variables are defined
     month_name = calendar.month_name[month]
     
@@ -741,6 +501,8 @@ def plot_histogram_clip(df, month, year):
 
 
 def plot_histogram_clean(df, month, year):
+    import seaborn as sns
+    import matplotlib.pyplot as plt
     # Assuming month and year variables are defined
     month_name = calendar.month_name[month]
     
@@ -769,6 +531,7 @@ def plot_histogram_clean(df, month, year):
 #////////////////////////////////////////////////////////////////////////////////////////////////////////   
 
 def create_monthly_Box_plot(df, month, year):
+    import plotly.graph_objects as go
     fig = go.Figure()
 
     fig.add_trace(go.Box(x=df['module_id'], y=df['Min_Temp'], name='Min Temperature'))
@@ -1,123 +1,139 @@
+import numpy as np
 import pandas as pd
 import datetime
 
 # ----------------------------------------------------------
 
-def remove_outliers(year, start_month, end_month, temp_df, arpa_out_path):
+def remove_outliers(year, start_month, end_month, temp_df, arpa_out_path, per_sensor=False, end_year=None):
 
     pd.set_option('mode.chained_assignment', None)
 
     # Detect for each month if outliers are present and remove them
-    # Method used: Outliers = Observations with z-scores > 3 or < -3
-
-    cleaned_df = []
-
-    for m in range(start_month, end_month + 1):
-        if m < 9:
-            date_start_str = str(year) + '-0' + str(m) + '-01 00:00:00'
-            date_end_str = str(year) + '-0' + str(m + 1) + '-01 00:00:00'
-        elif m == 9:
-            date_start_str = str(year) + '-0' + str(m) + '-01 00:00:00'
-            date_end_str = str(year) + '-' + str(m + 1) + '-01 00:00:00'
-        elif m != 12:
-            date_start_str = str(year) + '-' + str(m) + '-01 00:00:00'
-            date_end_str = str(year) + '-' + str(m + 1) + '-01 00:00:00'
-        else:
-            date_start_str = str(year) + '-' + str(m) + '-01 00:00:00'
-            date_end_str = str(year + 1) + '-01-01 00:00:00'
+    # Method used: Outliers = Observations with z-scores > 3 or < -3, the z-scores being computed with the
+    # measures of all the stations of the month, or with the ones of the same sensor (IdSensore) if per_sensor is True.
+    # The months go from start_month of year to end_month of end_year (year by default)
+    if end_year is None:
+        end_year = year
+
+    # Parse the dates only once and assign every measure to its month
+    measure_time = pd.to_datetime(temp_df['Data'], format="%d/%m/%Y %H:%M:%S")
+    month_key = (measure_time.dt.year * 12 + measure_time.dt.month - 1).to_numpy()
+
+    # Get only the values of the months in the range, month by month
+    in_range = (month_key >= year * 12 + start_month - 1) & (month_key <= end_year * 12 + end_month - 1)
+    order = np.flatnonzero(in_range)[np.argsort(month_key[in_range], kind='stable')]
+    tot_cleaned_df = temp_df.iloc[order].assign(Data=measure_time.to_numpy()[order])
+
+    # find absolute value of z-score for each observation, with the mean and standard deviation of its group
+    groups = [month_key[order]]
+    if per_sensor:
+        groups.append(tot_cleaned_df['IdSensore'].to_numpy())
+    grouped_values = tot_cleaned_df['Valore'].groupby(groups)
+    tot_cleaned_df['zscore'] = (tot_cleaned_df['Valore'] - grouped_values.transform('mean')) / grouped_values.transform('std')
+
+    # only keep rows in dataframe with all z-scores less than absolute value of 3
+    tot_cleaned_df = tot_cleaned_df[(tot_cleaned_df.zscore > -3) & (tot_cleaned_df.zscore < 3)]
 
-        date_time_start = datetime.datetime.strptime(date_start_str, "%Y-%m-%d %H:%M:%S")
-        date_time_end = datetime.datetime.strptime(date_end_str, "%Y-%m-%d %H:%M:%S")
+    # Put the data into a CSV file
+    tot_cleaned_df.to_csv(arpa_out_path + 'ARPA_clean_%s-%s.csv' % (year, start_month), index=False)
 
-        # Get only the values in this range of time for all the stations
-        temp_df['Data'] = pd.to_datetime(temp_df['Data'], format="%d/%m/%Y %H:%M:%S")
-        temp_df_fil1 = temp_df[(temp_df['Data'] < date_time_end)]
-        temp_df_fil2 = temp_df_fil1[(temp_df_fil1['Data'] > date_time_start)]
+    return tot_cleaned_df
 
-        # find absolute value of z-score for each observation
-        mean = temp_df_fil2['Valore'].mean()
-        stdev = temp_df_fil2['Valore'].std()
 
-        temp_df_fil2['zscore'] = (temp_df_fil2.Valore - mean) / stdev
+# ----------------------------------------------------------
 
-        # only keep rows in dataframe with all z-scores less than absolute value of 3
-        data_clean = temp_df_fil2[(temp_df_fil2.zscore > -3) & (temp_df_fil2.zscore < 3)]
+def create_virtual_station(year, start_month, end_month, temp_df, arpa_out_path, statistics=None):
+    pd.set_option('mode.chained_assignment', None)
 
-        cleaned_df.append(data_clean)
+    # Compute for each date the statistics of all the stations (VIRTUAL_STATION_STATS by default)
+    if statistics is None:
+        statistics = VIRTUAL_STATION_STATS
 
-    tot_cleaned_df = pd.concat(cleaned_df)
+    # Hourly time axis of the selected months, leap years included
+    date_time_start = datetime.datetime(year, start_month, 1)
+    date_time_end = datetime.datetime(year + end_month // 12, end_month % 12 + 1, 1)
+    hours = pd.date_range(date_time_start, date_time_end, freq='h', inclusive='left')
 
-    # Put the data into a CSV file
-    ARPA_cleaned_csv = tot_cleaned_df.to_csv(arpa_out_path + 'ARPA_clean_%s-%s.csv' % (year, start_month), index=False)
+    # Assign every measure to its hour (parsing the dates only once) and compute the pandas aggregations in one pass
+    measure_hour = pd.to_datetime(temp_df['Data'], format="%Y-%m-%d %H:%M:%S").dt.floor('h')
+    aggregations = [aggregation for aggregation, _ in statistics.values() if isinstance(aggregation, str)]
+    hourly_stats = temp_df['Valore'].groupby(measure_hour).agg(aggregations).reindex(hours)
 
-    return tot_cleaned_df
+    # The other statistics are computed from the measures sorted once by hour and value
+    if len(aggregations) < len(statistics):
+        values, starts, counts = _sorted_hours(hours.get_indexer(measure_hour), temp_df['Valore'].to_numpy(dtype=float), len(hours))
+
+    virtual_station = pd.DataFrame({'datetime': hours})
+    for column, (aggregation, decimals) in statistics.items():
+        if isinstance(aggregation, str):
+            stat = hourly_stats[aggregation].to_numpy()
+        else:
+            stat = aggregation(values, starts, counts)
+
+        if aggregation == 'size':
+            stat = np.nan_to_num(stat).astype(int)
+        elif decimals is not None:
+            stat = np.round(stat, decimals)
+        virtual_station[column] = stat
+
+    # Put the data into a CSV file
+    virtual_station.to_csv(arpa_out_path + 'ARPA_virtual_station_%s-%s.csv' % (year, start_month), index=False)
 
+    return virtual_station
 
 # ----------------------------------------------------------
+# Statistics of the measures of every hour, computed on the measures sorted by hour and by value:
+# values[starts[h]:starts[h] + counts[h]] are the measures of the hour h, in increasing order
+# ----------------------------------------------------------
 
-def create_virtual_station(year, start_month, end_month, temp_df, arpa_out_path):
-    pd.set_option('mode.chained_assignment', None)
+def _sorted_hours(hour_codes, values, nb_hours):
+    valid = (hour_codes >= 0) & ~np.isnan(values)
+    hour_codes = hour_codes[valid]
+    values = values[valid]
 
-    # Compute for each date the mean and standard deviation of all the stations
-
-    # New dictionary to store the hourly average
-    temp_dict = {'datetime': [],
-                 'avgTemp': [],
-                 'median': [],
-                 'minTemp': [],
-                 'maxTemp': [],
-                 'stdev': [],
-                 #'madev': [],
-                 'nb_measures': []}
-
-    for m in range(start_month, end_month + 1):
-        print(m)
-        print("\n")
-        if m in [1, 3, 5, 7, 8, 10, 12]:
-            nb_days = 31
-
-        # Be careful with the leap years: 2012, 2016, 2020
-        elif m == 2:
-            if year == 2016 or year == 2020 or year == 2012 or year == 2024:
-                nb_days = 29
-            else:
-                nb_days = 28
+    order = np.lexsort((values, hour_codes))
+    counts = np.bincount(hour_codes, minlength=nb_hours)
+    starts = np.cumsum(counts) - counts
+    return values[order], starts, counts
 
-        else:
-            nb_days = 30
-
-        for d in range(1, nb_days + 1):
-
-            for h in range(0, 24):
-                # Start time for the measures
-                start = str(year) + '-' + str(m) + '-' + str(d) + ' ' + str(h) + ':00:00'
-                date_time_start = datetime.datetime.strptime(start, "%Y-%m-%d %H:%M:%S")
-
-                # End time: adding one hour to the start
-                time_change = datetime.timedelta(minutes=60)
-                date_time_end = date_time_start + time_change
-
-                # Get only the values in this range of time for all the stations
-                temp_df['Data'] = pd.to_datetime(temp_df['Data'], format="%Y-%m-%d %H:%M:%S")
-                temp_df_fil1 = temp_df[(temp_df['Data'] < date_time_end)]
-                temp_df_fil2 = temp_df_fil1[(temp_df_fil1['Data'] > date_time_start)]
-
-                mean = temp_df_fil2['Valore'].mean()
-                temp_dict['avgTemp'].append(round(mean, 2))
-                median = temp_df_fil2['Valore'].median()
-                temp_dict['median'].append(round(median, 2))
-                temp_dict['minTemp'].append(temp_df_fil2['Valore'].min())
-                temp_dict['maxTemp'].append(temp_df_fil2['Valore'].max())
-                stdev = temp_df_fil2['Valore'].std()
-                temp_dict['stdev'].append(round(stdev, 3))
-                #madev = temp_df_fil2['Valore'].mad()
-                #temp_dict['madev'].append(round(madev, 3))
-                temp_dict['datetime'].append(date_time_start)
-                temp_dict['nb_measures'].append(len(temp_df_fil2))
-
-    virtual_station = pd.DataFrame(temp_dict)
 
-    # Put the data into a CSV file
-    milan_csv_data = temp_df.to_csv(arpa_out_path + 'ARPA_virtual_station_%s-%s.csv' % (year, start_month), index=False)
+def hourly_median(values, starts, counts):
+    median = np.full(len(counts), np.nan)
+    measured = counts > 0
+    median[measured] = (values[starts[measured] + (counts[measured] - 1) // 2] +
+                        values[starts[measured] + counts[measured] // 2]) / 2
+    return median
 
-    return virtual_station
+
+def hourly_madev(values, starts, counts):
+    # Median absolute deviation from the median of the hour (not scaled)
+    hour_codes = np.repeat(np.arange(len(counts)), counts)
+    deviations = np.abs(values - hourly_median(values, starts, counts)[hour_codes])
+    return pd.Series(deviations).groupby(hour_codes).median().reindex(range(len(counts))).to_numpy()
+
+
+def hourly_trimmed_mean(proportion=0.1):
+    # Mean of the measures of the hour without the lowest and highest `proportion` of them
+    def trimmed_mean(values, starts, counts):
+        cut = (proportion * counts).astype(int)
+        hour_codes = np.repeat(np.arange(len(counts)), counts)
+        rank = np.arange(len(values)) - starts[hour_codes]
+        kept = (rank >= cut[hour_codes]) & (rank < (counts - cut)[hour_codes])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.bincount(hour_codes[kept], weights=values[kept], minlength=len(counts)) / (counts - 2 * cut)
+    return trimmed_mean
+
+# ----------------------------------------------------------
+
+# Columns of the virtual station: column -> (aggregation, decimals). The aggregation is the name of a
+# pandas aggregation, or a function of the measures sorted by hour and value (as the ones above)
+VIRTUAL_STATION_STATS = {
+    'avgTemp': ('mean', 2),
+    'median': ('median', 2),
+    'minTemp': ('min', None),
+    'maxTemp': ('max', None),
+    'stdev': ('std', 3),
+    'madev': (hourly_madev, 3),
+    'trimmed_mean': (hourly_trimmed_mean(0.1), 2),
+    'nb_measures': ('size', None)
+}
@@ -0,0 +1,106 @@
+import os
+import time
+import traceback
+import pandas as pd
+from collections import deque
+from multiprocessing import Pool
+import arpa_cleaning as ac
+import netatmo_cleaning as nc
+from netatmo_storage import read_netatmo, netatmo_source_path
+
+# ----------------------------------------------------------------------
+# Cleaning of many months at once, as in 2a - Data_cleaning for every month:
+# remove_outliers and create_virtual_station for ARPA, then clean_netatmo_month.
+# The months are independent, so they are processed in parallel by a pool of
+# processes; every worker handles one month and is then replaced, so that the
+# memory of a month is released. The summary of every month is collected
+# into one report
+# ----------------------------------------------------------------------
+
+def clean_months(first_year, last_year=None, months=range(1, 13), arpa_out_path='Arpa_csv_files/',
+                 netatmo_out_path='Netatmo_csv_files/', max_workers=None, write_intermediate=False,
+                 file_format='csv'):
+
+    # Months from first_year to last_year (first_year only by default). The report is returned and written to
+    # <netatmo_out_path>/cleaning_report_<first_year>-<last_year>.csv
+    if last_year is None:
+        last_year = first_year
+
+    report = []
+    pending = deque()
+    max_pending = 2 * (max_workers or os.cpu_count() or 1)
+
+    # maxtasksperchild=1: a new process for every month
+    with Pool(processes=max_workers, maxtasksperchild=1) as pool:
+        for year, month, arpa_month in _arpa_by_month(first_year, last_year, months, arpa_out_path):
+
+            if arpa_month is None or netatmo_source_path(netatmo_out_path, year, month, 'clip') is None:
+                report.append({'year': year, 'month': month, 'status': 'missing data'})
+                continue
+
+            pending.append(pool.apply_async(clean_month, (year, month, arpa_month, arpa_out_path, netatmo_out_path,
+                                                          write_intermediate, file_format)))
+
+            # Only a few months waiting at once, the ARPA data of a month being kept until it is processed
+            if len(pending) >= max_pending:
+                report.append(pending.popleft().get())
+
+        report.extend(result.get() for result in pending)
+
+    report_df = pd.DataFrame(report).sort_values(['year', 'month']).reset_index(drop=True)
+    report_df.to_csv(os.path.join(netatmo_out_path, 'cleaning_report_%s-%s.csv' % (first_year, last_year)), index=False)
+
+    return report_df
+
+# ----------------------------------------------------------------------
+
+def _arpa_by_month(first_year, last_year, months, arpa_out_path):
+
+    # ARPA measures of every month (None if there is no file for the year), every year being read and parsed once
+    for year in range(first_year, last_year + 1):
+        arpa_file = arpa_out_path + 'ARPA_%s.csv' % year
+        if not os.path.exists(arpa_file):
+            for month in months:
+                yield year, month, None
+            continue
+
+        arpa_data = pd.read_csv(arpa_file)
+        arpa_data['Data'] = pd.to_datetime(arpa_data['Data'], format="%d/%m/%Y %H:%M:%S")
+        month_of_measure = arpa_data['Data'].dt.month
+
+        for month in months:
+            yield year, month, arpa_data[(month_of_measure == month) & (arpa_data['Data'].dt.year == year)]
+
+# ----------------------------------------------------------------------
+
+def clean_month(year, month, arpa_month, arpa_out_path, netatmo_out_path, write_intermediate=False, file_format='csv'):
+
+    # Whole cleaning of a month, returning its summary (or the error, so that the other months go on)
+    start = time.time()
+    summary = {'year': year, 'month': month}
+
+    try:
+        arpa_clean = ac.remove_outliers(year, month, month, arpa_month, arpa_out_path)
+        arpa_virtual_station = ac.create_virtual_station(year, month, month, arpa_clean, arpa_out_path)
+
+        original_netatmo_data = read_netatmo(netatmo_out_path, year, month, 'clip', categorical=False)
+        netatmo_filtered, stats = nc.clean_netatmo_month(year, month, netatmo_out_path, original_netatmo_data,
+                                                         arpa_virtual_station, write_intermediate, file_format)
+
+        summary.update({
+            'status': 'ok',
+            'arpa_measures': len(arpa_month),
+            'arpa_clean': len(arpa_clean),
+            'netatmo_stations': original_netatmo_data['module_id'].nunique(),
+            'netatmo_measures': len(original_netatmo_data),
+            'high_corr': stats['correlation_stats']['high_corr'].iloc[0],
+            'realistic': stats['unrealistic_stats']['in_range'].sum(),
+            'unbiased': stats['biased_tot_stats']['cleaned'].iloc[0],
+            'filtered_stations': netatmo_filtered['module_id'].nunique(),
+            'filtered_measures': len(netatmo_filtered),
+        })
+    except Exception:
+        summary.update({'status': 'failed', 'error': traceback.format_exc(limit=-1).strip()})
+
+    summary['seconds'] = round(time.time() - start, 1)
+    return summary
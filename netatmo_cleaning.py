@@ -1,64 +1,112 @@
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
+import os
+import numpy as np
 import pandas as pd
 import datetime
 from datetime import timedelta
+from netatmo_storage import write_netatmo
+from station_registry import STATION_COLUMNS, station_key as _station_key
 
 # ----------------------------------------------------------
 
-def compute_corr(year, month, temp_net_df, temp_arpa_df_original, netatmo_out_path):
-    pd.set_option('mode.chained_assignment', None)
+def _to_naive_time(time_col):
+    # Netatmo times are in UTC ("+00:00"), ARPA times are naive: drop the timezone to compare them
+    time_col = pd.to_datetime(time_col, format='ISO8601')
+    if time_col.dt.tz is not None:
+        time_col = time_col.dt.tz_localize(None)
+    return time_col
 
-    module_stations = temp_net_df.module_id.unique()
+# ----------------------------------------------------------
 
-    # Not necessary as it is not read from csv
-    # temp_arpa_df['datetime'] = pd.to_datetime(temp_arpa_df['datetime'], format="%Y-%m-%d %H:%M:%S")
+def _station_info(temp_net_df_station):
+    # identifier of every station, with its location when the measures carry it
+    key = _station_key(temp_net_df_station)
+    columns = [key] + [column for column in ['lat', 'long'] if column in temp_net_df_station.columns]
+    return temp_net_df_station.drop_duplicates(key)[columns]
 
-    # copy to avoid modification of the original virtual station
-    temp_arpa_df = temp_arpa_df_original.copy(deep=True)
-    temp_arpa_df['datetime'] = temp_arpa_df['datetime'] + timedelta(minutes=30)
-    temp_arpa_df.set_index('datetime', inplace=True)
+# ----------------------------------------------------------
 
-    # Compute the correlation for each station
-    corr_dict = {
-        'module_id': [],
-        'lat': [],
-        'long': [],
-        'year': [],
-        'pearson_coef': []
-    }
+def _station_rows(temp_net_df):
+    # Keep, for every station, only the measures taken at its first location (lat/long),
+    # with the stations one after the other in order of appearance.
+    # The observation tables of station_registry are already reduced to it (see to_observations)
+    key = _station_key(temp_net_df)
+    temp_net_df = temp_net_df[temp_net_df[key].notna()]
 
-    for station in module_stations:
-        if not pd.isna(station):
-            # Filter the df to have only the measures of the module
-            temp_net_df_mod = temp_net_df[(temp_net_df['module_id'] == station)]
-            lat_module = temp_net_df_mod['lat'].iloc[0]
-            long_module = temp_net_df_mod['long'].iloc[0]
-            temp_net_df_station = temp_net_df_mod[
-                (temp_net_df_mod['lat'] == lat_module) & (temp_net_df_mod['long'] == long_module)]
+    if 'lat' in temp_net_df.columns and 'long' in temp_net_df.columns:
+        first_location = temp_net_df.drop_duplicates(key).set_index(key)
+        same_location = ((temp_net_df['lat'] == temp_net_df[key].map(first_location['lat'])) &
+                         (temp_net_df['long'] == temp_net_df[key].map(first_location['long'])))
+        temp_net_df = temp_net_df[same_location]
 
-            # Modify time to be comparable with ARPA
-            temp_net_df_station['time'] = pd.to_datetime(temp_net_df_station['time'], format="%Y-%m-%d %H:%M:%S+00:00")
-            temp_net_df_station['time'] = temp_net_df_station['time'].dt.tz_localize(None)
-            temp_net_df_station = temp_net_df_station.drop_duplicates()
-            temp_net_df_station = temp_net_df_station.drop_duplicates()
-            temp_net_df_station.set_index('time', inplace=True)
+    station_codes, _ = pd.factorize(temp_net_df[key])
+    return temp_net_df.iloc[np.argsort(station_codes, kind='stable')].copy()
 
-            # Concat the two CSV to match the corresponding hours
-            concat_df = pd.concat([temp_arpa_df, temp_net_df_station], join='inner', axis=1)
+# ----------------------------------------------------------
+
+def _shift_virtual_station(temp_arpa_df):
+    # Modify the time of 30min to be able to match with Netatmo measures and index by it
+    temp_arpa_df = temp_arpa_df.set_index(temp_arpa_df['datetime'] + timedelta(minutes=30))
+    return temp_arpa_df[~temp_arpa_df.index.duplicated()]
+
+# ----------------------------------------------------------
 
-            correlation = concat_df['Temperature'].corr(concat_df['avgTemp'])
+# Scale of the median absolute deviation (madev) to compare it with a standard deviation
+MAD_SCALE = 1.4826
 
-            corr_dict['module_id'].append(station)
-            corr_dict['lat'].append(lat_module)
-            corr_dict['long'].append(long_module)
-            corr_dict['year'].append(year)
-            corr_dict['pearson_coef'].append(correlation)
+def _bias_reference(arpa_values, center='avgTemp', spread='stdev'):
+    # Centre and spread of the virtual station for the 3-sigma test, e.g. median and madev instead of
+    # avgTemp and stdev, less sensitive to a few faulty ARPA sensors
+    spread_values = arpa_values[spread]
+    if spread == 'madev':
+        spread_values = spread_values * MAD_SCALE
+    return arpa_values[center], spread_values
+
+# ----------------------------------------------------------
+
+def _prepare_netatmo(temp_net_df):
+    # Measures of each station at its first location, with times comparable with ARPA and without duplicates
+    temp_net_df_station = _station_rows(temp_net_df)
+    temp_net_df_station['time'] = _to_naive_time(temp_net_df_station['time'])
+    return temp_net_df_station.drop_duplicates()
+
+# ----------------------------------------------------------
+
+def compute_corr(year, month, temp_net_df, temp_arpa_df_original, netatmo_out_path):
+    pd.set_option('mode.chained_assignment', None)
 
-    df_corr = pd.DataFrame(corr_dict)
+    df_corr = _corr_by_station(year, _prepare_netatmo(temp_net_df), _shift_virtual_station(temp_arpa_df_original))
 
     # Put the data into a CSV file
-    corr_csv = df_corr.to_csv(netatmo_out_path + 'corr_ARPA_netatmo_%s-%s.csv' % (year, month), index=False)
+    df_corr.to_csv(netatmo_out_path + 'corr_ARPA_netatmo_%s-%s.csv' % (year, month), index=False)
+    return df_corr
+
+
+def _corr_by_station(year, temp_net_df_station, arpa_values):
+    key = _station_key(temp_net_df_station)
+
+    # Match every measure with the corresponding hour of the virtual station
+    pairs = pd.DataFrame({
+        'station': temp_net_df_station[key],
+        'netatmo': temp_net_df_station['Temperature'],
+        'arpa': temp_net_df_station['time'].map(arpa_values['avgTemp'])
+    }).dropna()
+
+    # Compute the Pearson coefficient of all the stations at once from the deviations to their means
+    deviations = pairs[['netatmo', 'arpa']] - pairs.groupby('station', sort=False)[['netatmo', 'arpa']].transform('mean')
+    products = pd.DataFrame({
+        'cov': deviations['netatmo'] * deviations['arpa'],
+        'var_netatmo': deviations['netatmo'] ** 2,
+        'var_arpa': deviations['arpa'] ** 2
+    }).groupby(pairs['station'], sort=False).sum()
+    pearson_coef = products['cov'] / np.sqrt(products['var_netatmo'] * products['var_arpa'])
+
+    df_corr = _station_info(temp_net_df_station)
+    df_corr['year'] = year
+    df_corr['pearson_coef'] = df_corr[key].map(pearson_coef)
+    df_corr.reset_index(drop=True, inplace=True)
+
     return df_corr
 
 # ----------------------------------------------------------
@@ -76,9 +124,10 @@ def remove_low_corr(year, month, netatmo_out_path, corr_df, temp_net_df):
     # Open the Netatmo CSV file containing the correlations
     # corr_df = pd.read_csv('corr_ARPA_netatmo_csv_%s.csv' % (year), skiprows=0)
 
-    # Filter to obtain the module_id of stations with corr >= 0.6
+    # Filter to obtain the module_id (or station_id) of stations with corr >= 0.6
+    key = _station_key(temp_net_df)
     high_corr_df = corr_df[(corr_df['pearson_coef'] >= 0.6)]
-    high_corr_modules = high_corr_df.module_id.unique()
+    high_corr_modules = high_corr_df[key].unique()
 
     # Open the Netatmo CSV file containing the hourly measures
     # temp_Net_df = pd.read_csv('temp_Net_milan_clip_%s.csv' % (year), skiprows=0)
@@ -86,7 +135,7 @@ def remove_low_corr(year, month, netatmo_out_path, corr_df, temp_net_df):
     removals['initial'].append(len(temp_net_df))
 
     # Filter to keep only the stations with corr >= 0.6
-    temp_net_high_corr_df = temp_net_df[(temp_net_df.module_id.isin(high_corr_modules))]
+    temp_net_high_corr_df = temp_net_df[(temp_net_df[key].isin(high_corr_modules))]
     removals['high_corr'].append(len(temp_net_high_corr_df))
 
     # Put cleaned data into a csv
@@ -103,277 +152,372 @@ def remove_low_corr(year, month, netatmo_out_path, corr_df, temp_net_df):
 
 # ----------------------------------------------------------
 
-def remove_unrealistic_values(year, month, netatmo_out_path, temp_net_df, temp_arpa_df):
+def remove_unrealistic_values(year, month, netatmo_out_path, temp_net_df, temp_arpa_df, per_hour=False):
     pd.set_option('mode.chained_assignment', None)
 
-    module_stations = temp_net_df.module_id.unique()
+    df_concat, df_stats_removals = _remove_unrealistic(year, _station_rows(temp_net_df), temp_arpa_df, per_hour)
+
+    df_concat.to_csv(netatmo_out_path + 'temp_Net_milan_%s-%s_realistic.csv' % (year, month), index=False)
+    # Put also the removals into a csv
+    df_stats_removals.to_csv(netatmo_out_path + 'temp_Net_milan_%s-%s_unrealistic_stats.csv' % (year, month), index=False)
+
+    return df_concat, df_stats_removals
+
+
+def _remove_unrealistic(year, temp_net_df_station, temp_arpa_df, per_hour=False):
     # Remove value out of range
 
     # Get the maximum and minimum values of ARPA, add/remove 2 degrees for possible fluctuations (UHI effect...)
     maximum = temp_arpa_df['maxTemp'].max() + 2
     minimum = temp_arpa_df['minTemp'].min() - 2
 
-    # To store the stats of removals
-    removals_out_min_max = {
-        'initial': [],
-        'in_range': [],
-        'removed': [],
-        'module_id': [],
-        'lat': [],
-        'long': [],
-        'year': [],
-    }
-
-    # To store cleaned dataframes
-    all_df = []
-
-    # For every station, remove value out of range
-    for station in module_stations:
-        if not pd.isna(station):
-            # Filter the df to have only the measures of the station
-            temp_net_df_mod = temp_net_df[(temp_net_df['module_id'] == station)]
-            lat_module = temp_net_df_mod['lat'].iloc[0]
-            long_module = temp_net_df_mod['long'].iloc[0]
-            temp_net_df_station = temp_net_df_mod[
-                (temp_net_df_mod['lat'] == lat_module) & (temp_net_df_mod['long'] == long_module)]
-            removals_out_min_max['initial'].append(len(temp_net_df_station))
-
-            # Filter the df to have only the measures in the range
-            temp_net_df_in_range = temp_net_df_station[
-                (temp_net_df_station['Temperature'] > minimum) & (temp_net_df_station['Temperature'] < maximum)]
-            removals_out_min_max['in_range'].append(len(temp_net_df_in_range))
-            removals_out_min_max['removed'].append((1 - len(temp_net_df_in_range) / len(temp_net_df_station)) * 100)
-            all_df.append(temp_net_df_in_range)
-
-            # Add data of the station
-            removals_out_min_max['module_id'].append(station)
-            removals_out_min_max['lat'].append(lat_module)
-            removals_out_min_max['long'].append(long_module)
-            removals_out_min_max['year'].append(year)
-
-    df_concat = pd.concat(all_df)
-    df_stats_removals = pd.DataFrame(removals_out_min_max)
-    
-    df_concat.to_csv(netatmo_out_path + 'temp_Net_milan_%s-%s_realistic.csv' % (year, month), index=False)
-    # Put also the removals into a csv
-    df_stats_removals.to_csv(netatmo_out_path + 'temp_Net_milan_%s-%s_unrealistic_stats.csv' % (year, month), index=False)
+    if per_hour:
+        # Range of the virtual station at the time of every measure (same hours as in remove_biased_series),
+        # the one of the whole month when the virtual station has no value
+        arpa_values = _shift_virtual_station(temp_arpa_df)
+        time = _to_naive_time(temp_net_df_station['time'])
+        maximum = (time.map(arpa_values['maxTemp']) + 2).fillna(maximum).to_numpy()
+        minimum = (time.map(arpa_values['minTemp']) - 2).fillna(minimum).to_numpy()
+
+    # Filter the df to have only the measures in the range
+    in_range = (temp_net_df_station['Temperature'] > minimum) & (temp_net_df_station['Temperature'] < maximum)
+    df_concat = temp_net_df_station[in_range]
+
+    # Stats of removals of every station
+    removals_out_min_max = in_range.groupby(temp_net_df_station[_station_key(temp_net_df_station)], sort=False).agg(['size', 'sum'])
+    df_stats_removals = pd.DataFrame({
+        'initial': removals_out_min_max['size'].to_numpy(),
+        'in_range': removals_out_min_max['sum'].to_numpy(),
+        'removed': (1 - removals_out_min_max['sum'].to_numpy() / removals_out_min_max['size'].to_numpy()) * 100
+    })
+
+    # Add data of the stations
+    df_stats_removals = pd.concat([df_stats_removals, _station_info(temp_net_df_station).reset_index(drop=True)], axis=1)
+    df_stats_removals['year'] = year
 
     return df_concat, df_stats_removals
 
 # ----------------------------------------------------------
 
-def remove_biased_series(year, month, netatmo_out_path, temp_net_df, temp_arpa_df_original):
+def remove_biased_series(year, month, netatmo_out_path, temp_net_df, temp_arpa_df_original, center='avgTemp', spread='stdev'):
     pd.set_option('mode.chained_assignment', None)
 
-    # Variable to store the removals at different steps
-    removals_outliers_ref_arpa = {
-        'initial': [],
-        'cleaned': []
-    }
+    tot_cleaned_df, df_stats = _remove_biased(year, _prepare_netatmo(temp_net_df), _shift_virtual_station(temp_arpa_df_original),
+                                              center, spread)
 
-    removals_outliers_ref_arpa['initial'].append(len(temp_net_df))
-    module_stations = temp_net_df.module_id.unique()
-
-    # copy to avoid modification of the original virtual station
-    temp_arpa_df = temp_arpa_df_original.copy(deep=True)
-
-    # Modify the time of 30min to be able to match with Netatmo measures
-    temp_arpa_df['datetime'] = temp_arpa_df['datetime'] + timedelta(minutes=30)
-
-    # Variables for the cleaning
-    temp_net_df_cleaned = []
-    stats_cleaning = {
-        'module_id': [],
-        'lat': [],
-        'long': [],
-        'year': [],
-        'removed_values': []
-    }
+    # Variable to store the removals at different steps
+    df_removals = pd.DataFrame({
+        'initial': [len(temp_net_df)],
+        'cleaned': [len(tot_cleaned_df)]
+    })
 
-    # For every station, compare each hourly measure with the virtual hourly mean
-    for station in module_stations:
-        nb_measures = 0
-        removed_mesures = 0
-
-        if not pd.isna(station):
-
-            # Filter the df to have only the measures of the station
-            temp_net_df_mod = temp_net_df[(temp_net_df['module_id'] == station)]
-            lat_module = temp_net_df_mod['lat'].iloc[0]
-            long_module = temp_net_df_mod['long'].iloc[0]
-            temp_net_df_station = temp_net_df_mod[
-                (temp_net_df_mod['lat'] == lat_module) & (temp_net_df_mod['long'] == long_module)]
-
-            # Modify time to be comparable with ARPA
-            temp_net_df_station['time'] = pd.to_datetime(temp_net_df_station['time'], format="%Y-%m-%d %H:%M:%S+00:00")
-            temp_net_df_station['time'] = temp_net_df_station['time'].dt.tz_localize(None)
-            temp_net_df_station = temp_net_df_station.drop_duplicates()
-
-            temp_net_df_station_cleaned = temp_net_df_station.copy(deep=True)
-
-            # Compare the station measure with the ARPA values
-            for idx, row in temp_net_df_station.iterrows():
-                nb_measures += 1
-                net_value = row['Temperature']
-                arpa_row = temp_arpa_df[(temp_arpa_df['datetime'] == row['time'])]
-                arpa_value = arpa_row['avgTemp'].values[0]
-                arpa_std = arpa_row['stdev'].values[0]
-                upper_bound = arpa_value + 3 * arpa_std
-                lower_bound = arpa_value - 3 * arpa_std
-
-                if (net_value > upper_bound) or (net_value < lower_bound):
-                    # Remove the measure
-                    temp_net_df_station_cleaned = temp_net_df_station_cleaned.drop(idx)
-                    # Count the nb of removed measures
-                    removed_mesures += 1
-
-            # For the final cleaned dataframe
-            temp_net_df_cleaned.append(temp_net_df_station_cleaned)
-
-            # For the stats
-            stats_cleaning['module_id'].append(station)
-            stats_cleaning['lat'].append(temp_net_df_station['lat'].values[0])
-            stats_cleaning['long'].append(temp_net_df_station['long'].values[0])
-            stats_cleaning['year'].append(year)
-
-            if nb_measures > 0:
-                percentage_removed = removed_mesures / nb_measures * 100
-            else:
-                percentage_removed = 0
-            stats_cleaning['removed_values'].append(percentage_removed)
-
-    tot_cleaned_df = pd.concat(temp_net_df_cleaned)
-    removals_outliers_ref_arpa['cleaned'].append(len(tot_cleaned_df))
-    df_stats = pd.DataFrame(stats_cleaning)
-    df_removals = pd.DataFrame(removals_outliers_ref_arpa)
-    
-    #tot_cleaned_df.reset_index(drop=True, inplace=True)  # Reset index to ensure monotonicity
-    
     tot_cleaned_df.to_csv(netatmo_out_path + 'temp_Net_milan_%s-%s_unbiased.csv' % (year, month), index=False)
     # Put also the removals into a csv
     df_removals.to_csv(netatmo_out_path + 'temp_Net_milan_%s-%s_biased_tot_stats.csv' % (year, month), index=False)
     df_stats.to_csv(netatmo_out_path + 'temp_Net_milan_%s-%s_biased_station_stats.csv' % (year, month), index=False)
-    
 
     return tot_cleaned_df, df_removals, df_stats
 
-# ----------------------------------------------------------
 
-# Warning: This function modifies the index of the original dataframe
-def remove_local_outliers(year, month, netatmo_out_path, temp_net_df):
-    pd.set_option('mode.chained_assignment', None)
+def _remove_biased(year, temp_net_df_station, arpa_values, center='avgTemp', spread='stdev'):
+    # Join every measure with the virtual station (shifted of 30min to match Netatmo measures)
+    center_values, spread_values = _bias_reference(arpa_values, center, spread)
+    avg_temp = temp_net_df_station['time'].map(center_values)
+    std_temp = temp_net_df_station['time'].map(spread_values)
 
-    temp_net_df.set_index('time', inplace=True)
-    module_stations = temp_net_df.module_id.unique()
+    # Compare each hourly measure with the virtual hourly mean +/- 3 standard deviations.
+    # Hours without a reference value from ARPA cannot be tested, so the measures are kept
+    upper_bound = avg_temp + 3 * std_temp
+    lower_bound = avg_temp - 3 * std_temp
+    biased = (temp_net_df_station['Temperature'] > upper_bound) | (temp_net_df_station['Temperature'] < lower_bound)
 
-    temp_net_df_rm = []
+    tot_cleaned_df = temp_net_df_station[~biased]
 
-    # For every station, apply the rolling mean
-    for station in module_stations:
+    # Percentage of removed measures for every station
+    key = _station_key(temp_net_df_station)
+    grouped = biased.groupby(temp_net_df_station[key], sort=False)
+    df_stats = _station_info(temp_net_df_station)
+    df_stats['year'] = year
+    df_stats['removed_values'] = df_stats[key].map(grouped.sum() / grouped.size() * 100)
+    df_stats.reset_index(drop=True, inplace=True)
 
-        if not pd.isna(station):
-            # Filter the df to have only the measures of the station
-            temp_net_df_mod = temp_net_df[(temp_net_df['module_id'] == station)]
-            lat_module = temp_net_df_mod['lat'].iloc[0]
-            long_module = temp_net_df_mod['long'].iloc[0]
-            temp_net_df_station = temp_net_df_mod[
-                (temp_net_df_mod['lat'] == lat_module) & (temp_net_df_mod['long'] == long_module)]
+    return tot_cleaned_df, df_stats
 
-            # Apply th RM with 2 hours window
-            rm_temperature = temp_net_df_station.Temperature.rolling('3h', min_periods=1).mean()
+# ----------------------------------------------------------
 
-            # Replace the temperatures with the new ones
-            modified_df = temp_net_df_station.copy(deep=True)
-            modified_df['Temperature'] = rm_temperature
-            temp_net_df_rm.append(modified_df)
+def remove_local_outliers(year, month, netatmo_out_path, temp_net_df, window='3h', center=False):
+    pd.set_option('mode.chained_assignment', None)
+
+    total_df = _rolling_mean(_station_rows(temp_net_df), window, center)
 
-    total_df = pd.concat(temp_net_df_rm)
-    # The index is datetime
-    
-    #reset the index
-    total_df.reset_index(inplace=True)
-    #total_df.drop(columns=['level_1'], inplace=True)
-    
-    
     total_df.to_csv(netatmo_out_path + 'temp_Net_milan_%s-%s_clean.csv' % (year, month), index=False)
 
     return total_df
 
+
+def _rolling_mean(temp_net_df_station, window='3h', center=False):
+
+    # Sort once the measures by station (in order of appearance) and time, and apply the rolling mean
+    # of all the stations in one grouped call (3 hours window by default, centered if center is True)
+    station_codes = pd.factorize(temp_net_df_station[_station_key(temp_net_df_station)])[0]
+    order = np.lexsort((temp_net_df_station['time'].to_numpy(), station_codes))
+
+    total_df = temp_net_df_station.iloc[order].set_index('time')
+    rm_temperature = total_df.groupby(station_codes[order], sort=False)['Temperature'] \
+        .rolling(window, min_periods=1, center=center).mean()
+
+    # Replace the temperatures with the new ones (same order, the groups being contiguous)
+    total_df['Temperature'] = rm_temperature.to_numpy()
+
+    # The index is datetime: reset the index
+    return total_df.reset_index()
+
 # --------------------------------------------------------------------------------------------
 #Add a further step of cleaning based on the reliability index
 # --------------------------------------------------------------------------------------------
 
-def remove_unreliable_stations(temp_net_df, temp_net_cleaned, netatmo_out_path, year, month):
-    columns = ['module_id', 'device_id', 'lat', 'long', 'timezone', 'country', 'altitude',
-               'city', 'street', 'geometry']
+def remove_unreliable_stations(temp_net_df, temp_net_cleaned, netatmo_out_path, year, month, stations=None):
+    # Same function in analysis_functions. The files are not written if netatmo_out_path is None
+    reliability_df, filtered_stations, removed_stations, temp_net_filtered = _station_reliability(temp_net_df, temp_net_cleaned, stations)
+
+    if netatmo_out_path is not None:
+        temp_net_filtered.to_csv(netatmo_out_path + 'temp_Net_milan_%s-%s_filtered.csv' % (year, month), index=False)
+        reliability_df.to_csv(reliability_csv_path(netatmo_out_path, year, month), index=False)
+    return reliability_df, filtered_stations, removed_stations, temp_net_filtered
+
+
+def reliability_csv_path(netatmo_out_path, year, month):
+    # <netatmo_out_path>/Reliability_Index/stations_reliability_<year>-<month>.csv, the folder being created if needed
+    reliability_path = os.path.join(netatmo_out_path, 'Reliability_Index')
+    os.makedirs(reliability_path, exist_ok=True)
+    return os.path.join(reliability_path, 'stations_reliability_%s-%s.csv' % (year, month))
+
+
+def _station_reliability(temp_net_df, temp_net_cleaned, stations=None):
+    # the metadata are only in the measures not reduced to observation tables (see station_registry),
+    # or in the table of the stations if given
+    key = _station_key(temp_net_df)
+    if stations is None:
+        stations = temp_net_cleaned
+    columns = [column for column in STATION_COLUMNS[1:] if column in stations.columns and column != key]
+
+    # Number of measures of every station remaining after the cleaning, and before it
+    reliability_df = temp_net_cleaned[key].value_counts().sort_index().rename('n.obs(cleaned)').to_frame()
+    reliability_df.insert(0, 'n.obs(original)', temp_net_df[key].value_counts().reindex(reliability_df.index))
 
-    df1_n_obs = temp_net_df.groupby('module_id').size().reset_index(name='n.obs(original)')
-    df1 = pd.merge(df1_n_obs, temp_net_df.drop_duplicates('module_id')[columns], on='module_id', how='left')
-    
-    df2_n_obs = temp_net_cleaned.groupby('module_id').size().reset_index(name='n.obs(cleaned)')
-    df2 = pd.merge(df2_n_obs, temp_net_cleaned.drop_duplicates('module_id')[columns], on='module_id', how='left')
-    
-    # First, merge only the specified column from df1 to df2 based on the common key 'module_id'
-    merged_columns = pd.merge(df1[['module_id','n.obs(original)']], df2[['module_id']], on='module_id', how='left')
-    
-    # Merge the merged_column back to df2 based on the common key 'module_id'
-    reliability_df = pd.merge(df2, merged_columns, on='module_id', how='left')
-    
     reliability_df['n.obs(removed)'] = reliability_df['n.obs(original)']-reliability_df['n.obs(cleaned)']
     reliability_df['(r_percentage)'] = reliability_df['n.obs(removed)']/reliability_df['n.obs(original)']
     reliability_df['sens_reliability'] = reliability_df['n.obs(cleaned)'] / reliability_df['n.obs(original)']
-    reliability_df = reliability_df.fillna(0)
-    
-    # Reorder the columns
-    reliability_df = reliability_df[['module_id', 'n.obs(original)', 'n.obs(cleaned)', 'n.obs(removed)', '(r_percentage)',
-                                     'sens_reliability', 'device_id', 'lat', 'long', 'timezone', 'country', 'altitude', 'city', 
-                                     'street', 'geometry']]
-    
+
+    # Join the data of the stations (first row of every station)
+    reliability_df = reliability_df.join(stations.drop_duplicates(key).set_index(key)[columns])
+    reliability_df = reliability_df.rename_axis(key).reset_index().fillna(0)
+
     # Filter df1 based on sens_reliability
     filtered_stations = reliability_df[reliability_df['sens_reliability'] >= 0.5]
     removed_stations = reliability_df[reliability_df['sens_reliability'] <= 0.5]
     filtered_stations.reset_index(drop=True, inplace=True)
     removed_stations.reset_index(drop=True, inplace=True)
-    
+
     # Get the list of module IDs with reliability >= 0.5
-    reliable_stations = filtered_stations['module_id'].tolist()
-    
+    reliable_stations = filtered_stations[key].tolist()
+
     # Filter df2 based on reliable_module_ids
-    temp_net_filtered = temp_net_cleaned[temp_net_cleaned['module_id'].isin(reliable_stations)]
+    temp_net_filtered = temp_net_cleaned[temp_net_cleaned[key].isin(reliable_stations)]
     temp_net_filtered.reset_index(drop=True, inplace=True)
-    
-    temp_net_filtered.to_csv(netatmo_out_path + 'temp_Net_milan_%s-%s_filtered.csv' % (year, month), index=False)
-    reliability_df.to_csv(netatmo_out_path + 'Reliability_Index\stations_reliability_%s-%s.csv' % (year, month), index=False)
+
     return reliability_df, filtered_stations, removed_stations, temp_net_filtered
 
+# --------------------------------------------------------------------------------------------
+# Whole cleaning procedure of a month, run in memory
+# --------------------------------------------------------------------------------------------
+
+def clean_netatmo_month(year, month, netatmo_out_path, temp_net_df, temp_arpa_df, write_intermediate=False,
+                        file_format='csv', per_hour_bounds=False, bias_center='avgTemp', bias_spread='stdev'):
+    pd.set_option('mode.chained_assignment', None)
+
+    # Same steps as compute_corr -> remove_low_corr -> remove_unrealistic_values -> remove_biased_series ->
+    # remove_local_outliers -> remove_unreliable_stations, but the measures are grouped by station and the
+    # times parsed only once. The intermediate files are written only if write_intermediate is True,
+    # as CSV or Parquet files (see netatmo_storage) depending on file_format, with the same rows and
+    # statistics as the files of the functions run one after the other
+    stats = {}
+    key = _station_key(temp_net_df)
+    arpa_values = _shift_virtual_station(temp_arpa_df)
+
+    # Measures of every station at its first location as read (for remove_unrealistic_values),
+    # and the same measures with parsed times and without duplicates (as _prepare_netatmo)
+    temp_net_rows = _station_rows(temp_net_df).reset_index(drop=True)
+    temp_net_df_station = temp_net_rows.assign(time=_to_naive_time(temp_net_rows['time'])).drop_duplicates()
+
+    # Keep only the stations with corr >= 0.6
+    stats['correlation'] = _corr_by_station(year, temp_net_df_station, arpa_values)
+    high_corr_modules = stats['correlation'].loc[stats['correlation']['pearson_coef'] >= 0.6, key]
+    temp_net_high_corr = temp_net_df[temp_net_df[key].isin(high_corr_modules)]
+    stats['correlation_stats'] = pd.DataFrame({
+        'initial': [len(temp_net_df)],
+        'high_corr': [len(temp_net_high_corr)],
+        'removed': [(1 - len(temp_net_high_corr) / len(temp_net_df)) * 100]
+    })
+
+    # Remove the values out of the ARPA range (of the month, or of every hour if per_hour_bounds is True)
+    temp_net_realistic, stats['unrealistic_stats'] = _remove_unrealistic(
+        year, temp_net_rows[temp_net_rows[key].isin(high_corr_modules)], temp_arpa_df, per_hour_bounds)
+
+    # Remove the values out of the virtual station mean +/- 3 standard deviations (or bias_center +/- 3 bias_spread),
+    # on the parsed measures kept by the previous step
+    temp_net_unbiased, stats['biased_station_stats'] = _remove_biased(
+        year, temp_net_df_station[temp_net_df_station.index.isin(temp_net_realistic.index)], arpa_values,
+        bias_center, bias_spread)
+    stats['biased_tot_stats'] = pd.DataFrame({
+        'initial': [len(temp_net_realistic)],
+        'cleaned': [len(temp_net_unbiased)]
+    })
+
+    # Smooth the local outliers with the rolling mean
+    temp_net_clean = _rolling_mean(temp_net_unbiased)
+
+    # Remove the stations with more than 50% of measurements removed
+    stats['reliability'], _, _, temp_net_filtered = _station_reliability(temp_net_df, temp_net_clean)
+
+    if write_intermediate:
+        stats['correlation'].to_csv(netatmo_out_path + 'corr_ARPA_netatmo_%s-%s.csv' % (year, month), index=False)
+        for stage in ['correlation_stats', 'unrealistic_stats', 'biased_tot_stats', 'biased_station_stats']:
+            stats[stage].to_csv(netatmo_out_path + 'temp_Net_milan_%s-%s_%s.csv' % (year, month, stage), index=False)
+
+        write_netatmo(temp_net_high_corr, netatmo_out_path, year, month, 'high_corr', file_format)
+        write_netatmo(temp_net_realistic, netatmo_out_path, year, month, 'realistic', file_format)
+        write_netatmo(temp_net_unbiased, netatmo_out_path, year, month, 'unbiased', file_format)
+        write_netatmo(temp_net_clean, netatmo_out_path, year, month, 'clean', file_format)
+
+    write_netatmo(temp_net_filtered, netatmo_out_path, year, month, 'filtered', file_format)
+    stats['reliability'].to_csv(reliability_csv_path(netatmo_out_path, year, month), index=False)
+
+    return temp_net_filtered, stats
+
+# --------------------------------------------------------------------------------------------
+# Dense representation of a month: a (stations x hours) float32 matrix of temperatures ("cube"),
+# with NaN where there is no measure, on the hourly axis of the virtual station (shifted of 30min).
+# It takes 4 bytes x stations x hours, and the cleaning steps become operations along its axes
+# --------------------------------------------------------------------------------------------
+
+def to_station_cube(temp_net_df, temp_arpa_df):
+
+    # Measures of each station at its first location, without duplicates; the ones out of the
+    # hourly axis (e.g. sub-hourly measures) are left out, and the first measure of an hour is kept
+    temp_net_df_station = _prepare_netatmo(temp_net_df)
+    hours = _shift_virtual_station(temp_arpa_df).index
+
+    station_codes, stations = pd.factorize(temp_net_df_station[_station_key(temp_net_df_station)])
+    hour_codes = hours.get_indexer(temp_net_df_station['time'])
+    on_axis = hour_codes >= 0
+
+    # one measure per (station, hour): np.unique gives the first row of every pair
+    linear = station_codes[on_axis] * len(hours) + hour_codes[on_axis]
+    cells, first_rows = np.unique(linear, return_index=True)
+
+    cube = np.full((len(stations), len(hours)), np.nan, dtype=np.float32)
+    cube.reshape(-1)[cells] = temp_net_df_station['Temperature'].to_numpy()[on_axis][first_rows]
+
+    return cube, stations, hours
+
+# ----------------------------------------------------------
+
+def from_station_cube(cube, stations, hours, key='module_id'):
+
+    # Back to the long format (one row per measure, station by station and in time order)
+    station_index, hour_index = np.nonzero(~np.isnan(cube))
+    return pd.DataFrame({
+        key: stations[station_index],
+        'time': hours[hour_index],
+        'Temperature': cube[station_index, hour_index]
+    })
+
+# ----------------------------------------------------------
+
+def _arpa_on_hours(temp_arpa_df, hours, column):
+    return _shift_virtual_station(temp_arpa_df)[column].reindex(hours).to_numpy()
+
+# ----------------------------------------------------------
+
+def cube_corr(cube, stations, hours, temp_arpa_df):
+
+    # Pearson coefficient of every station with the virtual station, over the hours where both have a value
+    arpa = _arpa_on_hours(temp_arpa_df, hours, 'avgTemp')
+    valid = ~np.isnan(cube) & ~np.isnan(arpa)
+    nb_valid = valid.sum(axis=1)
+
+    netatmo_values = np.where(valid, cube, 0).astype(np.float64)
+    arpa_values = np.where(valid, arpa, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        netatmo_dev = np.where(valid, netatmo_values - (netatmo_values.sum(axis=1) / nb_valid)[:, None], 0)
+        arpa_dev = np.where(valid, arpa_values - (arpa_values.sum(axis=1) / nb_valid)[:, None], 0)
+        pearson_coef = (netatmo_dev * arpa_dev).sum(axis=1) / np.sqrt((netatmo_dev ** 2).sum(axis=1) * (arpa_dev ** 2).sum(axis=1))
+
+    return pd.Series(pearson_coef, index=stations, name='pearson_coef')
+
+# ----------------------------------------------------------
+
+def cube_remove_unrealistic(cube, temp_arpa_df):
+
+    # Remove the values out of the ARPA range (+/- 2 degrees)
+    maximum = temp_arpa_df['maxTemp'].max() + 2
+    minimum = temp_arpa_df['minTemp'].min() - 2
+    return np.where((cube > minimum) & (cube < maximum), cube, np.float32(np.nan))
+
+# ----------------------------------------------------------
+
+def cube_remove_biased(cube, hours, temp_arpa_df, center='avgTemp', spread='stdev'):
+
+    # Remove the values out of the virtual hourly mean +/- 3 standard deviations (kept if no ARPA value)
+    center_values, spread_values = _bias_reference(_shift_virtual_station(temp_arpa_df), center, spread)
+    avg_temp = center_values.reindex(hours).to_numpy()
+    std_temp = spread_values.reindex(hours).to_numpy()
+    biased = (cube > avg_temp + 3 * std_temp) | (cube < avg_temp - 3 * std_temp)
+    return np.where(biased, np.float32(np.nan), cube)
+
+# ----------------------------------------------------------
+
+def cube_rolling_mean(cube, window=3):
+
+    # Mean of the measures of the last `window` hours (the current one included) at every measure,
+    # as the time-based rolling('3h', min_periods=1) of the long format
+    present = ~np.isnan(cube)
+    values = np.where(present, cube, 0).astype(np.float64)
+
+    padding = np.zeros((cube.shape[0], 1))
+    sums = np.cumsum(np.hstack([padding, values]), axis=1)
+    counts = np.cumsum(np.hstack([padding, present]), axis=1)
+    window_sums = sums[:, 1:] - sums[:, np.maximum(np.arange(cube.shape[1]) + 1 - window, 0)]
+    window_counts = counts[:, 1:] - counts[:, np.maximum(np.arange(cube.shape[1]) + 1 - window, 0)]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(present, window_sums / window_counts, np.nan).astype(np.float32)
+
 # ------------------------------------------------------------------------------------------------------------
 # Function to clean the data for affected module_ids by removing duplicates and intervals less than one hour
 # ------------------------------------------------------------------------------------------------------------
 
-def remove_irregularity_in_dataset(data , year, month):
-    cleaned_data = []
-
-    # Iterate over each module_id
-    for module_id in data['module_id'].unique():
-        module_data = data[data['module_id'] == module_id]
-
-        # Remove duplicate timestamps by keeping the first occurrence
-        module_data = module_data.drop_duplicates(subset=['time'])
-        module_data['time'] = pd.to_datetime(module_data['time'])
-        # Sort by time to ensure correct order
-        module_data = module_data.sort_values(by='time')
-        # Set the time column as the index
-        module_data.set_index('time', inplace=True)
-        # Calculate the time differences between consecutive rows
-        module_data['time_diff'] = module_data.index.to_series().diff().dt.total_seconds() / 3600
-        # Remove rows with time differences less than one hour
-        module_data = module_data[module_data['time_diff'].isna() | (module_data['time_diff'] >= 1)]
-        # Drop the time_diff column
-        module_data = module_data.drop(columns=['time_diff'])
-        # Reset the index
-        module_data.reset_index(inplace=True)
-        cleaned_data.append(module_data)
-    # Concatenate all cleaned module data
-    total_cleaned_data = pd.concat(cleaned_data)
-    total_cleaned_data.to_csv(netatmo_out_path + 'temp_Net_milan_%s-%s_clip.csv' % (year, month), index=False)
+def remove_irregularity_in_dataset(data, year, month, netatmo_out_path, file_format='csv'):
+
+    # Remove duplicate timestamps of every module_id by keeping the first occurrence
+    module_data = data[data['module_id'].notna()].drop_duplicates(subset=['module_id', 'time'])
+    time = pd.to_datetime(module_data['time'], format='ISO8601')
+
+    # Sort once by module_id (in order of appearance) and time
+    station_codes = pd.factorize(module_data['module_id'])[0]
+    order = np.lexsort((time.to_numpy(dtype='datetime64[ns]'), station_codes))
+    module_data = module_data.iloc[order].assign(time=time.iloc[order].array)
+
+    # Calculate the time differences between consecutive rows of the same module_id, and remove the rows
+    # with time differences less than one hour (the first row of every module_id is kept)
+    first_row = np.r_[True, station_codes[order][1:] != station_codes[order][:-1]]
+    time_diff = module_data['time'].diff().dt.total_seconds() / 3600
+    kept = first_row | (time_diff >= 1).to_numpy()
+
+    # time as first column, as in the previous files
+    columns = ['time'] + [column for column in module_data.columns if column != 'time']
+    total_cleaned_data = module_data.loc[kept, columns].reset_index(drop=True)
+
+    write_netatmo(total_cleaned_data, netatmo_out_path, year, month, 'clip', file_format)
     return total_cleaned_data
@@ -0,0 +1,108 @@
+import argparse
+import json
+import os
+import sys
+
+# ----------------------------------------------------------------------
+# Command line entry points of the download, cleaning and aggregation steps,
+# to run them without the notebooks (e.g. from cron on a server):
+#   python netatmo_cli.py download 2023 1 --credentials credentials.json --aoi aoi.gpkg --gpkg-path Netatmo_gpkg
+#   python netatmo_cli.py clean 2014 2023 --workers 8
+#   python netatmo_cli.py aggregate 2023 filtered --months 6 7 8 --window
+# Every command imports only the modules it needs
+# ----------------------------------------------------------------------
+
+def download(args):
+    from netatmo_download import get_measure_by_month_to_csv, concat_csv_files, filter_netatmo_stations, \
+        extract_netatmo_stations
+
+    # the patatmo credentials (username, password, client_id, client_secret) as a JSON file
+    with open(args.credentials) as credentials_file:
+        credentials = json.load(credentials_file)
+
+    # the stations are discovered in the area of interest if given, otherwise in the squares of Milan
+    get_measure_by_month_to_csv(credentials, args.year, args.month, args.out_path, args.workers, not args.no_resume,
+                                aoi=args.aoi)
+    concat_file = concat_csv_files(args.year, args.month, args.out_path)
+
+    # Keep only the stations in the area of interest (_clip file), and save them to a geopackage
+    if args.aoi:
+        filter_netatmo_stations(args.year, args.month, args.aoi, args.out_path, concat_file)
+        if args.gpkg_path:
+            extract_netatmo_stations(args.year, args.month, args.out_path, args.gpkg_path)
+    return 0
+
+# ----------------------------------------------------------------------
+
+def clean(args):
+    from batch_cleaning import clean_months
+
+    report = clean_months(args.first_year, args.last_year, args.months, args.arpa_path, args.netatmo_path,
+                          args.workers, args.write_intermediate, args.format)
+    print(report.to_string(index=False))
+
+    # exit code 1 if a month failed
+    return int((report['status'] == 'failed').any())
+
+# ----------------------------------------------------------------------
+
+def aggregate(args):
+    from netatmo_rollups import rollup_view, window_statistics
+
+    periods = [(args.year, month) for month in args.months]
+    if args.window:
+        stat = window_statistics(args.netatmo_path, periods, args.file_type, percentiles=args.percentiles)
+    else:
+        stat = rollup_view(args.netatmo_path, periods, args.file_type)
+
+    output = args.output or os.path.join(args.netatmo_path, '%s_%s_%s_%s-%s.csv' % (
+        'window' if args.window else 'monthly', args.file_type, args.year, args.months[0], args.months[-1]))
+    stat.to_csv(output, index=False)
+    print(output)
+    return 0
+
+# ----------------------------------------------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Download, cleaning and aggregation of Netatmo air temperature data')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_download = subparsers.add_parser('download', help='download the Netatmo measures of a month')
+    parser_download.add_argument('year', type=int)
+    parser_download.add_argument('month', type=int)
+    parser_download.add_argument('--credentials', required=True, help='JSON file with the patatmo credentials')
+    parser_download.add_argument('--out-path', default='Netatmo_csv_files')
+    parser_download.add_argument('--aoi', help='area of interest (e.g. aoi.gpkg) of the stations, to write the _clip file')
+    parser_download.add_argument('--gpkg-path', help='folder of the geopackages of the stations (with --aoi)')
+    parser_download.add_argument('--workers', type=int, default=4)
+    parser_download.add_argument('--no-resume', action='store_true', help='download again the stations in the journal')
+    parser_download.set_defaults(func=download)
+
+    parser_clean = subparsers.add_parser('clean', help='clean ARPA and Netatmo data of every month of one or more years')
+    parser_clean.add_argument('first_year', type=int)
+    parser_clean.add_argument('last_year', type=int, nargs='?')
+    parser_clean.add_argument('--months', type=int, nargs='+', default=list(range(1, 13)))
+    parser_clean.add_argument('--arpa-path', default='Arpa_csv_files/')
+    parser_clean.add_argument('--netatmo-path', default='Netatmo_csv_files/')
+    parser_clean.add_argument('--workers', type=int, help='number of processes (all the cores by default)')
+    parser_clean.add_argument('--write-intermediate', action='store_true', help='write the files of every cleaning step')
+    parser_clean.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    parser_clean.set_defaults(func=clean)
+
+    parser_aggregate = subparsers.add_parser('aggregate', help='monthly or whole-period statistics of the stations')
+    parser_aggregate.add_argument('year', type=int)
+    parser_aggregate.add_argument('file_type', help='cleaning step of the data, e.g. clip or filtered')
+    parser_aggregate.add_argument('--months', type=int, nargs='+', default=list(range(1, 13)))
+    parser_aggregate.add_argument('--window', action='store_true',
+                                  help='one row per station over all the months instead of one per month')
+    parser_aggregate.add_argument('--percentiles', type=float, nargs='*', default=[], help='e.g. 0.1 0.9 (with --window)')
+    parser_aggregate.add_argument('--netatmo-path', default='Netatmo_csv_files/')
+    parser_aggregate.add_argument('--output', help='CSV file (in the Netatmo folder by default)')
+    parser_aggregate.set_defaults(func=aggregate)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
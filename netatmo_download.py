@@ -3,312 +3,567 @@ from patatmo.api.errors import ApiResponseError
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 import os 
+import json
+import glob
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Point
+from shapely.geometry import Point, box
+from shapely.prepared import prep
+import shapely
+from functools import lru_cache
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from station_registry import register_stations
 
 # ----------------------------------------------------------------------
 
+# lat/lon outline of Milan/Italy, devided into 7 squares because of API requests limits
+MILAN_METROPOLE = {
+    '1-1' : 
+        {"lat_ne" : 45.65191141,
+        "lat_sw" : 45.451900,
+        "lon_ne" : 8.9900000,
+        "lon_sw" : 8.7000000,
+        },
+    '1-2': 
+        {
+        "lat_ne" : 45.451900,
+        "lat_sw" : 45.251900,
+        "lon_ne" : 8.9900000,
+        "lon_sw" : 8.7000000,
+        },
+    '2-1':
+        {
+        "lat_ne" : 45.65191141,
+        "lat_sw" : 45.451900,
+        "lon_ne" : 9.2800000,
+        "lon_sw" : 8.9900000,
+        },
+    '2-2':
+        {
+        "lat_ne" : 45.451900,
+        "lat_sw" : 45.251900,
+        "lon_ne" : 9.2800000,
+        "lon_sw" : 8.9900000,
+        },
+    '3-1': 
+        {
+        "lat_ne" : 45.65191141,
+        "lat_sw" : 45.451900,
+        "lon_ne" : 9.5700000,
+        "lon_sw" : 9.2800000,
+        }, 
+    '3-2': {
+        "lat_ne" : 45.451900,
+        "lat_sw" : 45.251900,
+        "lon_ne" : 9.5700000,
+        "lon_sw" : 9.2800000,
+        },
+    '4':{
+        "lat_ne" : 45.20457975,
+        "lat_sw" : 45.160000,
+        "lon_ne" : 9.5350000,
+        "lon_sw" : 9.43654192,
+        }
+}
+
+# Netatmo API quotas for a user, as (requests, seconds): 50 requests every 10 seconds and
+# 500 requests every hour (kept at 470, as in the previous waits, to leave a margin)
+NETATMO_RATE_LIMITS = [(50, 10), (470, 3600)]
 
-def get_measure_by_month_to_csv(credentials, year, month, out_path):
+# ----------------------------------------------------------------------
+
+class RateLimiter:
+
+    # Sliding windows shared by all the download threads: for every (requests, seconds) limit, the times of
+    # the last `requests` requests are kept, and a new request waits until the oldest of them is `seconds` old.
+    # No period of `seconds` ever holds more than `requests` requests, even at the start
+
+    def __init__(self, limits=NETATMO_RATE_LIMITS):
+        self.limits = limits
+        self.request_times = [deque(maxlen=requests) for requests, seconds in limits]
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # wait until every window has room for a request (and any pause is over), then record it
+        while True:
+            with self.lock:
+                now = time.monotonic()
+
+                wait = self.paused_until - now
+                for request_times, (requests, seconds) in zip(self.request_times, self.limits):
+                    if len(request_times) == requests:
+                        wait = max(wait, request_times[0] + seconds - now)
+
+                if wait <= 0:
+                    for request_times in self.request_times:
+                        request_times.append(now)
+                    return
+
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # stop all the threads for some time, e.g. after an error from the API
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+# ----------------------------------------------------------------------
+
+class _LockedAuthentication(patatmo.api.authentication.Authentication):
+
+    # The access token is refreshed when it is read, if it has expired: the download threads read it one at
+    # a time, so that a single thread refreshes it (and writes the tmpfile) while the others wait for the new one
+
+    def __init__(self, *args, **kwargs):
+        # reentrant, as the refresh reads and sets the tokens again in the same thread
+        self._tokens_lock = threading.RLock()
+        super().__init__(*args, **kwargs)
+
+    @property
+    def tokens(self):
+        with self._tokens_lock:
+            return patatmo.api.authentication.Authentication.tokens.fget(self)
+
+    @tokens.setter
+    def tokens(self, value):
+        with self._tokens_lock:
+            patatmo.api.authentication.Authentication.tokens.fset(self, value)
+
+# ----------------------------------------------------------------------
+
+def _create_client(credentials):
 
     # the netatmo connect developer credentials, retrieved from a .env file
     load_dotenv()
-    credentials = credentials
 
-    # configure the authentication
-    authentication = patatmo.api.authentication.Authentication(
+    # configure the authentication, shared by all the download threads
+    authentication = _LockedAuthentication(
         credentials = credentials,
         tmpfile = "temp_auth.json"
     )
 
     # create a api client
-    client = patatmo.api.client.NetatmoClient(authentication)
-
-
-    #Retrieve the devices of Milan
-
-    # lat/lon outline of Milan/Italy, devided into 7 squares because of API requests limits
-
-    # Square 1.1
-    milan_metropole = {
-        '1-1' : 
-            {"lat_ne" : 45.65191141,
-            "lat_sw" : 45.451900,
-            "lon_ne" : 8.9900000,
-            "lon_sw" : 8.7000000,
-            },
-        '1-2': 
-            {
-            "lat_ne" : 45.451900,
-            "lat_sw" : 45.251900,
-            "lon_ne" : 8.9900000,
-            "lon_sw" : 8.7000000,
-            },
-        '2-1':
-            {
-            "lat_ne" : 45.65191141,
-            "lat_sw" : 45.451900,
-            "lon_ne" : 9.2800000,
-            "lon_sw" : 8.9900000,
-            },
-        '2-2':
-            {
-            "lat_ne" : 45.451900,
-            "lat_sw" : 45.251900,
-            "lon_ne" : 9.2800000,
-            "lon_sw" : 8.9900000,
-            },
-        '3-1': 
-            {
-            "lat_ne" : 45.65191141,
-            "lat_sw" : 45.451900,
-            "lon_ne" : 9.5700000,
-            "lon_sw" : 9.2800000,
-            }, 
-        '3-2': {
-            "lat_ne" : 45.451900,
-            "lat_sw" : 45.251900,
-            "lon_ne" : 9.5700000,
-            "lon_sw" : 9.2800000,
-            },
-        '4':{
-            "lat_ne" : 45.20457975,
-            "lat_sw" : 45.160000,
-            "lon_ne" : 9.5350000,
-            "lon_sw" : 9.43654192,
-            }
-    }
-
-    square_list = ["1-1", "1-2", "2-1", "2-2", "3-1", "3-2", "4"]
-
-
-    # YEAR TO EXTRACT 
-    year = year
-
-
-    nb_request=0
-
-    #For all the year, make the range of months from 1 to 12; Otherwise modify the range
-    for m in range(month, month+1):
-
-        print(year)
-
-        for square in square_list:
-            # API request for stations and current measures
-            milan = client.Getpublicdata(region = milan_metropole[square], required_data='temperature', filter= True)
-            nb_request+=1
-
-            #Put the stations info in a list of dictionnaries
-            devices_list = []
-
-
-            for device in milan.response['body']:
-                device_data = {
-                    'device_id': device['_id'], 
-                    'module_id': device['modules'][0],
-                    'location': device['place']['location'],
-                    'timezone': device['place']['timezone'], 
-                    'country': device['place']['country'], 
-                    'altitude': device['place'].get('altitude', -999),
-                    'city': device['place'].get('city', ''), 
-                    'street': device['place'].get('street', '')
-                    }
-                devices_list.append(device_data)
-
-            #Now, retrieve the data of the selected date for each device
-
-            #Start and end time for the measures
-            if m < 9:
-                date_start_str = str(year)+'-0'+str(m)+'-01 00:00:00'
-                date_end_str = str(year)+'-0'+str(m+1)+'-01 00:00:00'
-            elif m == 9:
-                date_start_str = str(year)+'-0'+str(m)+'-01 00:00:00'
-                date_end_str = str(year)+'-'+str(m+1)+'-01 00:00:00'
-            elif m != 12:
-                date_start_str = str(year)+'-'+str(m)+'-01 00:00:00'
-                date_end_str = str(year)+'-'+str(m+1)+'-01 00:00:00'
-            else:
-                date_start_str = str(year)+'-'+str(m)+'-01 00:00:00'
-                date_end_str = str(year+1)+'-01-01 00:00:00'
-
-            start_datetime = datetime.strptime(date_start_str, "%Y-%m-%d %H:%M:%S")
-            end_datetime = datetime.strptime(date_end_str, "%Y-%m-%d %H:%M:%S")
-
-            start_timestamp = start_datetime.replace(tzinfo=timezone.utc).timestamp()
-            end_timestamp = end_datetime.replace(tzinfo=timezone.utc).timestamp()
-
-
-            print("The number of devices:")
-            print(len(devices_list))
-            frames=[]
-
-            if len(devices_list) >0 :
-
-                for device in devices_list:
-                    if (device['location'][1]<milan_metropole[square]['lat_ne'] and 
-                        device['location'][1]>milan_metropole[square]['lat_sw'] and 
-                        device['location'][0]<milan_metropole[square]['lon_ne'] and 
-                        device['location'][0]>milan_metropole[square]['lon_sw']):
-
-                        time.sleep(2)
-                        nb_request+=1
-                        print(nb_request)
-
-                        if nb_request > 470:
-                            #To know the the current time 
-                            currDate = datetime.now()
-                            print(currDate)
-
-                            print("Let's wait 45 min")
-                            time.sleep(2700)
-                            nb_request=0
-
-                        # API request to retrieve data from the outdoor module
-                        try: 
-                            outdoor = client.Getmeasure(
-                                device_id = device['device_id'], 
-                                module_id = device['module_id'],
-                                scale = "1hour",
-                                type = ["Temperature", 'min_temp', 'max_temp'],
-                                date_begin = start_timestamp,
-                                date_end = end_timestamp,
-                                )
-
-                            outdoor_df = outdoor.dataframe()
-
-                            if not outdoor_df.empty:
-                                outdoor_df = outdoor_df.assign(
-                                    device_id=device['device_id'],
-                                    module_id=device['module_id'],
-                                    lat=device['location'][1],
-                                    long=device['location'][0],
-                                    timezone=device['timezone'],
-                                    country=device['country'],
-                                    altitude=device['altitude'],
-                                    city=device['city'],
-                                    street=device['street']
-                                    )
-                                frames.append(outdoor_df)
-
-                        except ApiResponseError as e:
-                            print('ERROR WITH API RESPONSE')
-                            print(e)
-                            print(vars(e))
-                            time.sleep(240)
-                            pass
-
-                df_result = pd.concat(frames)
-                print(df_result)
-
-                # Put the result in a csv file
-                milan_csv_data = df_result.to_csv(out_path + '/temp_Net_milan_%s-%s-%s_%sh%s-%s-%s-%s_%sh%s_s%s.csv' % (date_start_str[8:10], date_start_str[5:7], 
-                                                                        date_start_str[:4], start_datetime.hour,start_datetime.minute,
-                                                                        date_end_str[8:10], date_end_str[5:7], date_end_str[:4], end_datetime.hour,
-                                                                        end_datetime.minute,square), index = True)
-
-            print('The number of requests made:')
-            print(nb_request)
-
-            #To know the the current time 
-            currDate = datetime.now()
-            print(currDate)
-
-            print("Just wait 5 min")
-            time.sleep(300)
+    return patatmo.api.client.NetatmoClient(authentication)
+
+# ----------------------------------------------------------------------
+
+def _month_bounds(year, month):
+    start_datetime = datetime(year, month, 1)
+    end_datetime = datetime(year + month // 12, month % 12 + 1, 1)
+    return start_datetime, end_datetime
+
+# ----------------------------------------------------------------------
+
+def _month_csv_prefix(out_path, start_datetime, end_datetime):
+    # e.g. temp_Net_milan_01-01-2023_0h0-01-02-2023_0h0
+    file_date = '%02d-%02d-%s_%sh%s'
+    return out_path + '/temp_Net_milan_%s-%s' % (
+        file_date % (start_datetime.day, start_datetime.month, start_datetime.year, start_datetime.hour, start_datetime.minute),
+        file_date % (end_datetime.day, end_datetime.month, end_datetime.year, end_datetime.hour, end_datetime.minute))
+
+
+def _square_csv_path(out_path, start_datetime, end_datetime, square):
+    return _month_csv_prefix(out_path, start_datetime, end_datetime) + '_s%s.csv' % square
+
+# ----------------------------------------------------------------------
+
+def _device_data(device):
+    return {
+        'device_id': device['_id'], 
+        'module_id': device['modules'][0],
+        'location': device['place']['location'],
+        'timezone': device['place']['timezone'], 
+        'country': device['place']['country'], 
+        'altitude': device['place'].get('altitude', -999),
+        'city': device['place'].get('city', ''), 
+        'street': device['place'].get('street', '')
+        }
+
+# ----------------------------------------------------------------------
+
+def get_public_devices(client, region, limiter=None):
+
+    # API request for stations and current measures
+    if limiter is not None:
+        limiter.acquire()
+    public_data = client.Getpublicdata(region = region, required_data='temperature', filter= True)
+
+    #Put the stations info in a list of dictionnaries (the stations on the border of the region included)
+    devices_list = []
+
+    for device in public_data.response['body']:
+        if (device['place']['location'][1]<=region['lat_ne'] and 
+            device['place']['location'][1]>=region['lat_sw'] and 
+            device['place']['location'][0]<=region['lon_ne'] and 
+            device['place']['location'][0]>=region['lon_sw']):
+
+            devices_list.append(_device_data(device))
+
+    return devices_list
+
+# ----------------------------------------------------------------------
+
+def get_station_measure(client, device, start_timestamp, end_timestamp, limiter, max_retries=3, backoff=60):
+
+    # API request to retrieve data from the outdoor module, retried after an error from the API.
+    # Every error pauses all the requests: backoff seconds after the first error of the station,
+    # then twice as long after each new error of the same station
+    for attempt in range(max_retries + 1):
+        limiter.acquire()
+
+        try: 
+            outdoor = client.Getmeasure(
+                device_id = device['device_id'], 
+                module_id = device['module_id'],
+                scale = "1hour",
+                type = ["Temperature", 'min_temp', 'max_temp'],
+                date_begin = start_timestamp,
+                date_end = end_timestamp,
+                )
+            break
+
+        except ApiResponseError as e:
+            print('ERROR WITH API RESPONSE')
+            print(e)
+            if attempt == max_retries:
+                raise
+            limiter.pause(backoff * 2 ** attempt)
+
+    outdoor_df = outdoor.dataframe()
+
+    if outdoor_df.empty:
+        return None
+
+    return outdoor_df.assign(
+        device_id=device['device_id'],
+        module_id=device['module_id'],
+        lat=device['location'][1],
+        long=device['location'][0],
+        timezone=device['timezone'],
+        country=device['country'],
+        altitude=device['altitude'],
+        city=device['city'],
+        street=device['street']
+        )
+
+# ----------------------------------------------------------------------
+
+def _download_station(client, device, start_timestamp, end_timestamp, limiter, journal_path=None):
+
+    # Without a journal, just download the measures of the station
+    if journal_path is None:
+        try:
+            return get_station_measure(client, device, start_timestamp, end_timestamp, limiter)
+        except ApiResponseError:
+            return None
+
+    # With a journal, every result is saved as soon as it arrives: the measures in <module_id>.csv,
+    # or an empty <module_id>.empty file when the station has no data. Stations already in the journal
+    # are not requested again, while the failed ones (<module_id>.failed) are retried
+    station_file = os.path.join(journal_path, device['module_id'].replace(':', '-'))
+
+    if os.path.exists(station_file + '.csv'):
+        outdoor_df = pd.read_csv(station_file + '.csv', index_col=0)
+        outdoor_df.index = pd.to_datetime(outdoor_df.index, format='ISO8601')
+        return outdoor_df
+    if os.path.exists(station_file + '.empty'):
+        return None
+
+    try:
+        outdoor_df = get_station_measure(client, device, start_timestamp, end_timestamp, limiter)
+    except ApiResponseError as e:
+        with open(station_file + '.failed', 'w') as failed_file:
+            failed_file.write(str(e))
+        return None
+
+    if outdoor_df is None:
+        open(station_file + '.empty', 'w').close()
+    else:
+        # write to a temporary file first, so that a crash never leaves a partial file in the journal
+        outdoor_df.to_csv(station_file + '.tmp', index = True)
+        os.replace(station_file + '.tmp', station_file + '.csv')
+
+    if os.path.exists(station_file + '.failed'):
+        os.remove(station_file + '.failed')
+
+    return outdoor_df
+
+# ----------------------------------------------------------------------
+
+def download_measures(client, devices_list, start_timestamp, end_timestamp, limiter=None, max_workers=4,
+                      journal_path=None):
+
+    # Getmeasure requests of all the devices, run by max_workers threads as fast as the limiter allows.
+    # If journal_path is given, the results are saved there and reused when downloading again
+    if limiter is None:
+        limiter = RateLimiter()
+
+    if journal_path is not None:
+        os.makedirs(journal_path, exist_ok=True)
 
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(
+            lambda device: _download_station(client, device, start_timestamp, end_timestamp, limiter, journal_path),
+            devices_list)
+        frames = [outdoor_df for outdoor_df in results if outdoor_df is not None]
+
+    return frames
 
 # ----------------------------------------------------------------------
 
-def concat_csv_files(year, month, out_path):
+def plan_measure_windows(start_timestamp, end_timestamp, scale_seconds=3600, max_points=1024):
+
+    # Split [start, end) in the fewest windows that a single Getmeasure request can return:
+    # at most 1024 points, i.e. about 42 days at the 1hour scale
+    window = scale_seconds * max_points
+    windows = []
 
-    if month > 9:
-        date_start_str = str(year) + '-' + str(month) + '-01 00:00:00'
-        if month == 12:
-            date_end_str = str(year+1) + '-01' + '-01 00:00:00'
-        else: date_end_str = str(year) + '-' + str(month+1) + '-01 00:00:00'
-    elif month <= 9:
-        date_start_str = str(year) + '-0' + str(month) + '-01 00:00:00'
-        if month == 12:
-            date_end_str = str(year+1) + '-01' + '-01 00:00:00'
-        else: date_end_str = str(year) + '-0' + str(month+1) + '-01 00:00:00'
+    window_start = start_timestamp
+    while window_start < end_timestamp:
+        window_end = min(window_start + window, end_timestamp)
+        windows.append((window_start, window_end))
+        window_start = window_end
 
+    return windows
+
+# ----------------------------------------------------------------------
+
+def _aoi_geometry(aoi):
+    # area of interest given as a file (e.g. 'aoi.gpkg') or as a shapely geometry in EPSG:4326
+    if isinstance(aoi, str):
+        return gpd.read_file(aoi).to_crs('EPSG:4326').union_all()
+    return aoi
+
+# ----------------------------------------------------------------------
 
-    start_datetime = datetime.strptime(date_start_str, "%Y-%m-%d %H:%M:%S")
-    end_datetime = datetime.strptime(date_end_str, "%Y-%m-%d %H:%M:%S")
+def get_devices_in_aoi(client, aoi, limiter=None, saturation=500, max_depth=6):
+
+    # Discover all the stations in the area of interest with a quadtree of Getpublicdata requests:
+    # starting from the bounding box of the area, a tile whose response holds `saturation` devices or
+    # more may have lost some stations, so it is split in 4 tiles that are requested again (up to
+    # max_depth times). Tiles out of the area are never requested, and the stations found by several
+    # tiles are kept once (by module_id)
+
+    aoi_geometry = _aoi_geometry(aoi)
+    prepared_aoi = prep(aoi_geometry)
+
+    devices = {}
+    lon_sw, lat_sw, lon_ne, lat_ne = aoi_geometry.bounds
+    tiles = [(lon_sw, lat_sw, lon_ne, lat_ne, 0)]
+
+    while len(tiles) > 0:
+        lon_sw, lat_sw, lon_ne, lat_ne, depth = tiles.pop()
+        if not prepared_aoi.intersects(box(lon_sw, lat_sw, lon_ne, lat_ne)):
+            continue
+
+        region = {"lat_ne": lat_ne, "lat_sw": lat_sw, "lon_ne": lon_ne, "lon_sw": lon_sw}
+        if limiter is not None:
+            limiter.acquire()
+        public_data = client.Getpublicdata(region = region, required_data='temperature', filter= True)
+
+        for device in public_data.response['body']:
+            location = device['place']['location']
+            if len(device['modules']) > 0 and prepared_aoi.covers(Point(location[0], location[1])):
+                devices.setdefault(device['modules'][0], _device_data(device))
+
+        if len(public_data.response['body']) >= saturation and depth < max_depth:
+            lon_mid = (lon_sw + lon_ne) / 2
+            lat_mid = (lat_sw + lat_ne) / 2
+            tiles += [(lon_sw, lat_sw, lon_mid, lat_mid, depth + 1),
+                      (lon_mid, lat_sw, lon_ne, lat_mid, depth + 1),
+                      (lon_sw, lat_mid, lon_mid, lat_ne, depth + 1),
+                      (lon_mid, lat_mid, lon_ne, lat_ne, depth + 1)]
+
+    return list(devices.values())
+
+# ----------------------------------------------------------------------
+
+def get_devices_by_square(client, limiter=None, device_cache=None, aoi=None):
+
+    # One Getpublicdata request per square of Milan, or the quadtree of requests of get_devices_in_aoi
+    # if an area of interest is given (all its stations are then in the 'aoi' square). With device_cache
+    # (a JSON file), the devices found the first time are saved and reused afterwards without any request
+    if device_cache is not None and os.path.exists(device_cache):
+        with open(device_cache) as cache_file:
+            return json.load(cache_file)
+
+    if aoi is not None:
+        devices_by_square = {'aoi': get_devices_in_aoi(client, aoi, limiter)}
+
+    else:
+        # a station on the border of two squares is kept only in the first one
+        devices_by_square = {}
+        found_modules = set()
+        for square in MILAN_METROPOLE:
+            devices_list = get_public_devices(client, MILAN_METROPOLE[square], limiter)
+            devices_by_square[square] = [device for device in devices_list if device['module_id'] not in found_modules]
+            found_modules.update(device['module_id'] for device in devices_list)
+
+    if device_cache is not None:
+        with open(device_cache, 'w') as cache_file:
+            json.dump(devices_by_square, cache_file)
+
+    return devices_by_square
+
+# ----------------------------------------------------------------------
+
+def _month_periods(start_datetime, end_datetime):
+    # the months between start and end, cut at start and end
+    periods = []
+    period_start = start_datetime
+    while period_start < end_datetime:
+        period_end = min(_month_bounds(period_start.year, period_start.month)[1], end_datetime)
+        periods.append((period_start, period_end))
+        period_start = period_end
+    return periods
+
+# ----------------------------------------------------------------------
+
+def get_measure_by_range_to_csv(credentials, start_date, end_date, out_path, device_cache=None, max_workers=4,
+                                resume=True, aoi=None):
+
+    # Download the measures between start_date (included) and end_date (excluded), e.g. '2023-01-01'
+    # and '2024-01-01', and write one csv file per square and per month, as get_measure_by_month_to_csv.
+    # The devices are discovered once (in the squares of Milan, or in any area of interest given as aoi),
+    # and every station is downloaded with the fewest Getmeasure requests
+
+    client = _create_client(credentials)
+
+    # the same limiter for all the requests, so that the quotas are respected across the squares
+    limiter = RateLimiter()
+
+    start_datetime = pd.Timestamp(start_date).to_pydatetime()
+    end_datetime = pd.Timestamp(end_date).to_pydatetime()
     start_timestamp = start_datetime.replace(tzinfo=timezone.utc).timestamp()
     end_timestamp = end_datetime.replace(tzinfo=timezone.utc).timestamp()
 
+    periods = _month_periods(start_datetime, end_datetime)
+    windows = plan_measure_windows(start_timestamp, end_timestamp)
 
-    # If you used different times or names, you can replace each of the following lines by 
-    # df_x = pd.read_csv('name_of_your_file.csv') and modify the line 53 with your df_x !
+    devices_by_square = get_devices_by_square(client, limiter, device_cache, aoi)
 
-    df1_1 = pd.read_csv(out_path + '/temp_Net_milan_%s-%s-%s_%sh%s-%s-%s-%s_%sh%s_s1-1.csv' % (date_start_str[8:10], date_start_str[5:7], 
-                                                            date_start_str[:4], start_datetime.hour,start_datetime.minute,
-                                                            date_end_str[8:10], date_end_str[5:7], date_end_str[:4], end_datetime.hour,
-                                                            end_datetime.minute))
+    for square, devices_list in devices_by_square.items():
+        square_csvs = [_square_csv_path(out_path, period_start, period_end, square) for period_start, period_end in periods]
+        if resume and all(os.path.exists(square_csv) for square_csv in square_csvs):
+            continue
 
-    df1_2 = pd.read_csv(out_path + '/temp_Net_milan_%s-%s-%s_%sh%s-%s-%s-%s_%sh%s_s1-2.csv' % (date_start_str[8:10], date_start_str[5:7], 
-                                                            date_start_str[:4], start_datetime.hour,start_datetime.minute,
-                                                            date_end_str[8:10], date_end_str[5:7], date_end_str[:4], end_datetime.hour,
-                                                            end_datetime.minute))
+        print("The number of devices:")
+        print(len(devices_list))
 
-    df2_1 = pd.read_csv(out_path + '/temp_Net_milan_%s-%s-%s_%sh%s-%s-%s-%s_%sh%s_s2-1.csv' % (date_start_str[8:10], date_start_str[5:7], 
-                                                            date_start_str[:4], start_datetime.hour,start_datetime.minute,
-                                                            date_end_str[8:10], date_end_str[5:7], date_end_str[:4], end_datetime.hour,
-                                                            end_datetime.minute))
+        # Retrieve the data of every window for each device
+        frames = []
+        for i, (window_start, window_end) in enumerate(windows):
+            journal_path = None
+            if resume:
+                journal_path = os.path.join(out_path, 'journal', '%s-%s' % (start_datetime.strftime('%Y%m%d'),
+                                            end_datetime.strftime('%Y%m%d')), 's%s' % square, 'w%s' % i)
+            frames += download_measures(client, devices_list, window_start, window_end, limiter, max_workers,
+                                        journal_path)
 
-    df2_2 = pd.read_csv(out_path + '/temp_Net_milan_%s-%s-%s_%sh%s-%s-%s-%s_%sh%s_s2-2.csv' % (date_start_str[8:10], date_start_str[5:7], 
-                                                            date_start_str[:4], start_datetime.hour,start_datetime.minute,
-                                                            date_end_str[8:10], date_end_str[5:7], date_end_str[:4], end_datetime.hour,
-                                                            end_datetime.minute))
+        if len(frames) > 0:
+            df_result = pd.concat(frames)
+            df_result.index = pd.to_datetime(df_result.index, utc=True)
+            df_result.index.name = 'time'
 
-    df3_1 = pd.read_csv(out_path + '/temp_Net_milan_%s-%s-%s_%sh%s-%s-%s-%s_%sh%s_s3-1.csv' % (date_start_str[8:10], date_start_str[5:7], 
-                                                            date_start_str[:4], start_datetime.hour,start_datetime.minute,
-                                                            date_end_str[8:10], date_end_str[5:7], date_end_str[:4], end_datetime.hour,
-                                                            end_datetime.minute))
+            # the same measure could be returned by two consecutive windows
+            df_result = df_result[~df_result.set_index('module_id', append=True).index.duplicated()]
 
-    df3_2 = pd.read_csv(out_path + '/temp_Net_milan_%s-%s-%s_%sh%s-%s-%s-%s_%sh%s_s3-2.csv' % (date_start_str[8:10], date_start_str[5:7], 
-                                                            date_start_str[:4], start_datetime.hour,start_datetime.minute,
-                                                            date_end_str[8:10], date_end_str[5:7], date_end_str[:4], end_datetime.hour,
-                                                            end_datetime.minute))
+            # Put the result in one csv file per month
+            for (period_start, period_end), square_csv in zip(periods, square_csvs):
+                in_period = ((df_result.index >= pd.Timestamp(period_start, tz='UTC')) &
+                             (df_result.index < pd.Timestamp(period_end, tz='UTC')))
+                if in_period.any():
+                    df_result[in_period].to_csv(square_csv, index = True)
 
-    df4 = pd.read_csv(out_path + '/temp_Net_milan_%s-%s-%s_%sh%s-%s-%s-%s_%sh%s_s4.csv' % (date_start_str[8:10], date_start_str[5:7], 
-                                                            date_start_str[:4], start_datetime.hour,start_datetime.minute,
-                                                            date_end_str[8:10], date_end_str[5:7], date_end_str[:4], end_datetime.hour,
-                                                            end_datetime.minute))
+        #To know the the current time 
+        print(square, datetime.now())
 
-    df_concat = pd.concat([df1_1, df1_2, df2_1, df2_2, df3_1, df3_2, df4])
+# ----------------------------------------------------------------------
 
-    print(df_concat)
+def get_measure_by_month_to_csv(credentials, year, month, out_path, max_workers=4, resume=True, device_cache=None,
+                                aoi=None):
+
+    # With resume=True, every station is saved in a journal (out_path/journal/...) as soon as it is
+    # downloaded: after a crash, the squares already written and the stations already in the journal
+    # are not requested again
+    start_datetime, end_datetime = _month_bounds(year, month)
+    get_measure_by_range_to_csv(credentials, start_datetime, end_datetime, out_path, device_cache, max_workers, resume,
+                                aoi)
 
-    milan_csv_data = df_concat.to_csv(out_path + '/temp_Net_milan_%s-%s-%s_%sh%s-%s-%s-%s_%sh%s_concat.csv' % (date_start_str[8:10], date_start_str[5:7], 
-                                                            date_start_str[:4], start_datetime.hour,start_datetime.minute,
-                                                            date_end_str[8:10], date_end_str[5:7], date_end_str[:4], end_datetime.hour,
-                                                            end_datetime.minute), index = True)
 
-    
-    
 # ----------------------------------------------------------------------
 
-def filter_netatmo_stations(year, month, aoi, out_path):
-    
-    # create GeoDataFrame with the boundary of the area of interest (from GeoPackage file)
-    gdf_geopackage = gpd.read_file('aoi.gpkg', crs='EPSG:4326')
+def concat_csv_files(year, month, out_path, chunksize=100000):
+
+    # Merge the csv files of all the squares of the month (whatever their number: s1-1 ... s4, saoi, ...)
+    # into the _concat.csv file, reading and appending them chunk by chunk. The measures downloaded twice
+    # (same module_id and time, e.g. from overlapping tiles) are written only once
+
+    start_datetime, end_datetime = _month_bounds(year, month)
+    month_prefix = _month_csv_prefix(out_path, start_datetime, end_datetime)
+    square_files = sorted(glob.glob(glob.escape(month_prefix) + '_s*.csv'))
+
+    out_file = month_prefix + '_concat.csv'
+    if os.path.exists(out_file):
+        os.remove(out_file)
+
+    # hashes of the (module_id, time) keys already written, kept sorted: 8 bytes per measure
+    written_keys = np.empty(0, dtype=np.uint64)
+    nb_rows = 0
+
+    for square_file in square_files:
+        for chunk in pd.read_csv(square_file, chunksize=chunksize):
+            keys = pd.util.hash_pandas_object(chunk[['module_id', 'time']], index=False).values
+            new_rows = ~pd.Series(keys).duplicated().values & ~np.isin(keys, written_keys)
+
+            chunk[new_rows].to_csv(out_file, mode='a', header=(nb_rows == 0), index=False)
+            nb_rows += new_rows.sum()
+            written_keys = np.sort(np.concatenate([written_keys, keys[new_rows]]))
+
+    print(out_file)
+    print(nb_rows)
+
+    return out_file
+
+# ----------------------------------------------------------------------
+
+@lru_cache(maxsize=4)
+def _read_aoi(aoi):
+    # boundary of the area of interest (from GeoPackage file), read once and reused for all the months;
+    # its spatial index (STRtree) is built here as well
+    gdf_geopackage = gpd.read_file(aoi)
+    if gdf_geopackage.crs is not None:
+        gdf_geopackage = gdf_geopackage.to_crs('EPSG:4326')
+    gdf_geopackage.sindex
+    return gdf_geopackage
+
+# ----------------------------------------------------------------------
+
+def filter_netatmo_stations(year, month, aoi, out_path, in_file=None):
     
-    # create a DataFrame with the Netatmo observations
-    data = out_path + '/temp_Net_milan_%s-%s.csv' % (year, month)
+    # create a DataFrame with the Netatmo observations (of the file renamed after concat_csv_files,
+    # or of in_file, e.g. the _concat.csv file it returns)
+    data = in_file or out_path + '/temp_Net_milan_%s-%s.csv' % (year, month)
     df_csv = pd.read_csv(data)
-    
-    # turn the DataFrame to a GeoDataFrame with associated coordinates
-    gdf_csv = gpd.GeoDataFrame(df_csv, geometry=gpd.points_from_xy(df_csv.long, df_csv.lat), crs='EPSG:4326')
-    
-    # filter Netatmo observations within the area of interest with a spatial join
-    filtered_data = gpd.sjoin(gdf_csv, gdf_geopackage, predicate='within')
-    
-    # select only the original columns
-    filtered_data = filtered_data[list(gdf_csv.columns)]
+
+    # the distinct locations of the stations: only these are tested against the area of interest
+    stations = df_csv[['module_id', 'lat', 'long']].drop_duplicates()
+    stations_points = gpd.points_from_xy(stations.long, stations.lat, crs='EPSG:4326')
+
+    # filter the stations within the area of interest with the spatial index
+    stations_within, _ = _read_aoi(aoi).sindex.query(stations_points, predicate='within')
+    stations_inside = np.zeros(len(stations), dtype=bool)
+    stations_inside[stations_within] = True
+
+    # filter the Netatmo observations of these stations, and add their geometry
+    station_of_row = pd.MultiIndex.from_frame(stations).get_indexer(pd.MultiIndex.from_frame(df_csv[['module_id', 'lat', 'long']]))
+    rows_inside = stations_inside[station_of_row]
+    filtered_data = df_csv[rows_inside].assign(
+        geometry=shapely.to_wkt(stations_points[station_of_row[rows_inside]], rounding_precision=-1))
     
     # save the filtered file to a csv
     out_file = out_path + '/temp_Net_milan_%s-%s_clip.csv' % (year, month)
@@ -319,22 +574,19 @@ def filter_netatmo_stations(year, month, aoi, out_path):
 def extract_netatmo_stations(year, month, out_path, gpkg_path):
     
     # read the csv file corresponding to the specified year/month as a pandas dataframe
-    df = pd.read_csv(out_path + '/temp_Net_milan_%s-%s_clip.csv' % (year, month))
-    
-    # create the geometry column starting from the long and lat coordinates
-    df['geometry'] = df.apply(lambda row: Point(row['long'], row['lat']), axis = 1)
+    df = pd.read_csv(out_path + '/temp_Net_milan_%s-%s_clip.csv' % (year, month),
+                     usecols = ['time', 'device_id', 'module_id', 'lat', 'long', 'timezone', 'country', 'altitude',
+                                'city', 'street'])
     
-    # convert it to a geodataframe
-    gdf = gpd.GeoDataFrame(df, geometry = 'geometry', crs = 'EPSG:4326')
+    # extract the stations (first row of each module_id) before building any geometry
+    stations = df.drop_duplicates(subset = 'module_id')
     
-    # extract the unique station identifiers
-    unique_module_ids = gdf['module_id'].unique()
-    
-    # extrat the corresponding rows (without diplicates)
-    filtered_gdf = gdf[gdf['module_id'].isin(unique_module_ids)].drop_duplicates(subset = 'module_id')
-    
-    # extract the relevant columns
-    filtered_gdf = filtered_gdf[['device_id', 'module_id', 'lat', 'long', 'altitude', 'city', 'street', 'geometry']]
+    # extract the relevant columns and create the geometry from the long and lat coordinates
+    stations = stations[['device_id', 'module_id', 'lat', 'long', 'altitude', 'city', 'street']]
+    filtered_gdf = gpd.GeoDataFrame(stations, geometry = gpd.points_from_xy(stations.long, stations.lat), crs = 'EPSG:4326')
     
     # save it to a geopackage
     filtered_gdf.to_file(gpkg_path + '/sensors_%s-%s.gpkg' % (year, month), driver = 'GPKG')
+
+    # add them to the registry of all the stations (see station_registry)
+    register_stations(df, year, month, gpkg_path + '/sensors.gpkg')
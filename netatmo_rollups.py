@@ -0,0 +1,202 @@
+import os
+import numpy as np
+import pandas as pd
+from netatmo_storage import read_netatmo, netatmo_source_path
+from station_registry import station_key
+
+# ----------------------------------------------------------------------
+# Monthly statistics of the Netatmo stations, computed once per month and
+# file type and cached in <folder_path>/rollups/<file_type>_<year>-<month>.parquet.
+# A cached month is computed again only if its source file is more recent,
+# and the annual, seasonal or any other views are composed from the cached months.
+#
+# Next to the statistics of the month, the cache keeps partial aggregates that can
+# be merged over several months: count, sum and sum of squares of the temperatures
+# (exact mean and std), and a histogram of the temperatures by 0.1 degree
+# (<file_type>_<year>-<month>_histogram.parquet) for the median and the percentiles.
+# The stations are identified by module_id, or by station_id for the observation
+# tables of station_registry, whose data are then joined back with attach_metadata
+# ----------------------------------------------------------------------
+
+STAT_COLUMNS = ['Min_Temp', 'Mean', 'Median', 'Max_Temp', 'Std']
+
+PARTIAL_COLUMNS = ['count', 'sum', 'sum_squares']
+
+STATION_COLUMNS = ['device_id', 'module_id', 'lat', 'long', 'timezone', 'country', 'altitude', 'city', 'street',
+                   'geometry']
+
+# Width of the bins of the histograms, in degrees: the Netatmo temperatures have one decimal,
+# so the percentiles of the raw measures are exact (and within 0.05 degrees for smoothed ones)
+HISTOGRAM_RESOLUTION = 0.1
+
+# ----------------------------------------------------------------------
+
+def station_columns(df):
+    # identifier and data of the stations in df (only the station_id in the observation tables)
+    columns = [column for column in STATION_COLUMNS if column in df.columns]
+    if station_key(df) not in columns:
+        columns.insert(0, station_key(df))
+    return columns
+
+# ----------------------------------------------------------------------
+
+def _month_keys(df):
+    # station (module_id or station_id) and month of every measure (the time being the last day of the month)
+    time = pd.to_datetime(df['time'], format='ISO8601')
+    return [df[station_key(df)], (time.dt.normalize() + pd.offsets.MonthEnd(0)).rename('time')]
+
+# ----------------------------------------------------------------------
+
+def monthly_statistics(df, partials=False):
+
+    # (min, mean, median, max, std) of the temperatures of every station in every month of df, in one pass,
+    # with the data of the station (first row of every station), and the partial aggregates if partials is True
+    key = station_key(df)
+    columns = station_columns(df)
+    stations = df[columns].drop_duplicates(subset=key, keep='first')
+
+    temperatures = pd.DataFrame({'Temperature': df['Temperature'], 'squares': df['Temperature'] ** 2})
+    grouped = temperatures.groupby(_month_keys(df))
+
+    monthly_stat = grouped['Temperature'].agg(['min', 'mean', 'median', 'max', 'std', 'count', 'sum'])
+    monthly_stat.columns = STAT_COLUMNS + PARTIAL_COLUMNS[:2]
+    monthly_stat['sum_squares'] = grouped['squares'].sum()
+    monthly_stat.reset_index(inplace=True)
+
+    monthly_stat = pd.merge(monthly_stat, stations, on=key, how='inner')
+    return monthly_stat[['time'] + STAT_COLUMNS + (PARTIAL_COLUMNS if partials else []) + columns]
+
+# ----------------------------------------------------------------------
+
+def monthly_histogram(df):
+
+    # Number of temperatures of every station and month in every bin of HISTOGRAM_RESOLUTION degrees
+    measured = df['Temperature'].notna()
+    keys = [key[measured] for key in _month_keys(df)]
+    keys.append((df.loc[measured, 'Temperature'] / HISTOGRAM_RESOLUTION).round().astype(int).rename('bin'))
+    return df.loc[measured, 'Temperature'].groupby(keys).size().rename('count').reset_index()
+
+# ----------------------------------------------------------------------
+
+def rollup_path(folder_path, year, month, file_type, cache_path=None, part=None):
+    if cache_path is None:
+        cache_path = os.path.join(folder_path, 'rollups')
+    if part:
+        return os.path.join(cache_path, '%s_%s-%s_%s.parquet' % (file_type, year, month, part))
+    return os.path.join(cache_path, '%s_%s-%s.parquet' % (file_type, year, month))
+
+# ----------------------------------------------------------------------
+
+def monthly_rollup(folder_path, year, month, file_type, cache_path=None):
+
+    # Statistics (with the partial aggregates) and histogram of the month, from the cache if it is more recent
+    # than the source file. None if there is no file for this month
+    source_file = netatmo_source_path(folder_path, year, month, file_type)
+    if source_file is None:
+        return None
+
+    stat_file = rollup_path(folder_path, year, month, file_type, cache_path)
+    histogram_file = rollup_path(folder_path, year, month, file_type, cache_path, 'histogram')
+    if all(os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source_file)
+           for path in [stat_file, histogram_file]):
+        return pd.read_parquet(stat_file), pd.read_parquet(histogram_file)
+
+    df = read_netatmo(folder_path, year, month, file_type, categorical=False)
+    monthly_stat = monthly_statistics(df, partials=True)
+    histogram = monthly_histogram(df)
+
+    os.makedirs(os.path.dirname(stat_file), exist_ok=True)
+    monthly_stat.to_parquet(stat_file, index=False)
+    histogram.to_parquet(histogram_file, index=False)
+    return monthly_stat, histogram
+
+# ----------------------------------------------------------------------
+
+def _monthly_rollups(folder_path, periods, file_type, cache_path):
+    # statistics and histograms of the months of periods with a file, each of them concatenated
+    # (empty tables if no month has a file)
+    rollups = [monthly_rollup(folder_path, year, month, file_type, cache_path) for year, month in periods]
+    rollups = [rollup for rollup in rollups if rollup is not None]
+    if len(rollups) == 0:
+        return pd.DataFrame(columns=['time'] + STAT_COLUMNS + PARTIAL_COLUMNS + STATION_COLUMNS), \
+            pd.DataFrame(columns=['module_id', 'time', 'bin', 'count'])
+    return pd.concat([rollup[0] for rollup in rollups], ignore_index=True), \
+        pd.concat([rollup[1] for rollup in rollups], ignore_index=True)
+
+# ----------------------------------------------------------------------
+
+def rollup_view(folder_path, periods, file_type, cache_path=None):
+
+    # Statistics of every station in every month of periods, a list of (year, month), as one row per
+    # station and month (NaN for the months without measures of the station)
+    df1, _ = _monthly_rollups(folder_path, periods, file_type, cache_path)
+
+    # Same times for the measures with and without time zone
+    df1['time'] = pd.to_datetime(df1['time'])
+    if df1['time'].dt.tz is not None:
+        df1['time'] = df1['time'].dt.tz_localize(None)
+
+    # One row for every station (data of its first month) and every month
+    key = station_key(df1)
+    columns = station_columns(df1)
+    stations = df1[columns].drop_duplicates(subset=key)
+    dates = pd.DatetimeIndex([pd.Timestamp(year, month, 1) + pd.offsets.MonthEnd(0) for year, month in periods])
+    grid = pd.MultiIndex.from_product([stations[key], dates], names=[key, 'time']).to_frame(index=False)
+    df2 = pd.merge(grid, stations, on=key, how='left')
+
+    # Left join with the statistics
+    view = pd.merge(df2, df1[[key, 'time'] + STAT_COLUMNS], on=[key, 'time'], how='left')
+    view.sort_values(by=[key, 'time'], inplace=True)
+
+    return view[['time'] + STAT_COLUMNS + columns]
+
+# ----------------------------------------------------------------------
+
+def window_statistics(folder_path, periods, file_type, cache_path=None, percentiles=()):
+
+    # Statistics of every station over all the months of periods, a list of (year, month), merged from the
+    # partial aggregates of the months: exact count, min, max, mean and std, median and percentiles (e.g. 0.1, 0.9)
+    # from the merged histograms. The time is the last day of the period
+    monthly_stats, histograms = _monthly_rollups(folder_path, periods, file_type, cache_path)
+
+    key = station_key(monthly_stats)
+    window_stat = monthly_stats.groupby(key).agg(
+        Min_Temp=('Min_Temp', 'min'), Max_Temp=('Max_Temp', 'max'),
+        count=('count', 'sum'), sum=('sum', 'sum'), sum_squares=('sum_squares', 'sum'))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        count = window_stat['count'].where(window_stat['count'] > 0)
+        window_stat['Mean'] = window_stat['sum'] / count
+        variance = (window_stat['sum_squares'] - window_stat['sum'] * window_stat['Mean']) / (count - 1)
+        window_stat['Std'] = np.sqrt(variance.clip(lower=0).where(count > 1))
+
+    # Median and percentiles of the merged histograms
+    histogram = histograms.groupby([key, 'bin'])['count'].sum()
+    percentile_columns = ['P%g' % (100 * q) for q in percentiles]
+    for column, q in zip(['Median'] + percentile_columns, (0.5,) + tuple(percentiles)):
+        window_stat[column] = _histogram_quantile(histogram, q).reindex(window_stat.index)
+
+    window_stat.reset_index(inplace=True)
+    window_stat['time'] = max(pd.Timestamp(year, month, 1) + pd.offsets.MonthEnd(0) for year, month in periods)
+
+    columns = station_columns(monthly_stats)
+    stations = monthly_stats[columns].drop_duplicates(subset=key)
+    window_stat = pd.merge(window_stat, stations, on=key, how='inner')
+    return window_stat[['time'] + STAT_COLUMNS + percentile_columns + ['count'] + columns]
+
+# ----------------------------------------------------------------------
+
+def _histogram_quantile(histogram, q):
+
+    # Quantile q of the temperatures of every station from its histogram (count by (station, bin), sorted),
+    # interpolated between the two closest ranks as pandas does
+    cumulative = histogram.to_numpy().cumsum()
+    totals = histogram.groupby(level=0, sort=False).sum()
+    starts = totals.cumsum().to_numpy() - totals.to_numpy()
+
+    bins = np.round(histogram.index.get_level_values('bin').to_numpy() * HISTOGRAM_RESOLUTION, 6)
+    position = (totals.to_numpy() - 1) * q
+    lower = bins[np.searchsorted(cumulative, starts + np.floor(position), side='right')]
+    upper = bins[np.searchsorted(cumulative, starts + np.ceil(position), side='right')]
+
+    return pd.Series(lower + (upper - lower) * (position - np.floor(position)), index=totals.index)
@@ -0,0 +1,147 @@
+import os
+import pandas as pd
+
+# ----------------------------------------------------------------------
+# Storage of the temp_Net_milan_<year>-<month>_<stage> tables, either as the
+# usual CSV files or as Parquet files partitioned by year and month:
+#   <out_path>/temp_Net_milan/year=<year>/month=<month>/<stage>.parquet
+# ----------------------------------------------------------------------
+
+# Metadata of the stations, repeated on every hourly row: stored with dictionary encoding
+METADATA_COLUMNS = ['device_id', 'module_id', 'timezone', 'country', 'city', 'street', 'geometry']
+
+# ----------------------------------------------------------------------
+
+def netatmo_csv_path(out_path, year, month, stage=None):
+    if stage:
+        return os.path.join(out_path, 'temp_Net_milan_%s-%s_%s.csv' % (year, month, stage))
+    return os.path.join(out_path, 'temp_Net_milan_%s-%s.csv' % (year, month))
+
+# ----------------------------------------------------------------------
+
+def netatmo_parquet_path(out_path, year, month, stage=None):
+    return os.path.join(out_path, 'temp_Net_milan', 'year=%s' % year, 'month=%s' % month,
+                        '%s.parquet' % (stage or 'raw'))
+
+# ----------------------------------------------------------------------
+
+def netatmo_source_path(out_path, year, month, stage=None):
+    # File read by read_netatmo: the most recently written of the Parquet and CSV files (None if there is none),
+    # so that a month cleaned again in the other format is not hidden by the file of the previous cleaning
+    paths = [path for path in [netatmo_parquet_path(out_path, year, month, stage),
+                               netatmo_csv_path(out_path, year, month, stage)] if os.path.exists(path)]
+    if len(paths) == 0:
+        return None
+    return max(paths, key=os.path.getmtime)
+
+# ----------------------------------------------------------------------
+
+def write_netatmo(df, out_path, year, month, stage=None, file_format='parquet'):
+
+    if file_format == 'csv':
+        out_file = netatmo_csv_path(out_path, year, month, stage)
+        df.to_csv(out_file, index=False)
+        return out_file
+
+    if file_format != 'parquet':
+        raise ValueError("file_format must be 'parquet' or 'csv', not %r" % file_format)
+
+    df = df.copy()
+
+    # store the times as timestamps, so that they can be filtered when reading
+    if 'time' in df.columns and not pd.api.types.is_datetime64_any_dtype(df['time']):
+        df['time'] = pd.to_datetime(df['time'], format='ISO8601')
+
+    # dictionary encoding of the metadata of the stations
+    for column in METADATA_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+
+    out_file = netatmo_parquet_path(out_path, year, month, stage)
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    df.to_parquet(out_file, index=False)
+    return out_file
+
+# ----------------------------------------------------------------------
+
+def read_netatmo(out_path, year, month, stage=None, columns=None, module_ids=None, start=None, end=None,
+                 categorical=True):
+
+    # Read a month of Netatmo measures, from the Parquet or CSV file written last (see netatmo_source_path).
+    # Only the given columns are read, and only the rows of the given module_ids with start <= time < end
+
+    source_file = netatmo_source_path(out_path, year, month, stage)
+
+    if source_file is not None and source_file.endswith('.parquet'):
+        df = _read_netatmo_parquet(source_file, columns, module_ids, start, end)
+    else:
+        df = _read_netatmo_csv(netatmo_csv_path(out_path, year, month, stage), columns, module_ids, start, end)
+
+    if not categorical:
+        for column in df.columns:
+            if isinstance(df[column].dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype(object)
+
+    return df.reset_index(drop=True)
+
+# ----------------------------------------------------------------------
+
+def _read_netatmo_parquet(parquet_file, columns, module_ids, start, end):
+    import pyarrow.parquet as pq
+
+    # the filters are pushed down to the Parquet reader, which skips the row groups out of them
+    filters = []
+    if module_ids is not None:
+        filters.append(('module_id', 'in', list(module_ids)))
+
+    if start is not None or end is not None:
+        time_tz = pq.read_schema(parquet_file).field('time').type.tz
+        if start is not None:
+            filters.append(('time', '>=', _as_time(start, time_tz)))
+        if end is not None:
+            filters.append(('time', '<', _as_time(end, time_tz)))
+
+    return pd.read_parquet(parquet_file, columns=columns, filters=filters or None)
+
+# ----------------------------------------------------------------------
+
+def _read_netatmo_csv(csv_file, columns, module_ids, start, end):
+
+    # the columns used by the filters are read even if they are not requested
+    usecols = None
+    if columns is not None:
+        usecols = list(columns)
+        if module_ids is not None and 'module_id' not in usecols:
+            usecols.append('module_id')
+        if (start is not None or end is not None) and 'time' not in usecols:
+            usecols.append('time')
+
+    df = pd.read_csv(csv_file, usecols=usecols)
+
+    if module_ids is not None:
+        df = df[df['module_id'].isin(module_ids)]
+
+    if start is not None or end is not None:
+        time = pd.to_datetime(df['time'], format='ISO8601')
+        in_period = pd.Series(True, index=df.index)
+        if start is not None:
+            in_period &= time >= _as_time(start, time.dt.tz)
+        if end is not None:
+            in_period &= time < _as_time(end, time.dt.tz)
+        df = df[in_period]
+
+    if columns is not None:
+        df = df[list(columns)]
+
+    return df
+
+# ----------------------------------------------------------------------
+
+def _as_time(value, tz):
+    # make a time bound comparable with the stored times (UTC for the raw Netatmo measures)
+    value = pd.Timestamp(value)
+    if tz is not None and value.tz is None:
+        return value.tz_localize(tz)
+    if tz is None and value.tz is not None:
+        return value.tz_convert('UTC').tz_localize(None)
+    return value
@@ -0,0 +1,152 @@
+import os
+import numpy as np
+import pandas as pd
+
+# ----------------------------------------------------------------------
+# Registry of the Netatmo stations (sensors.gpkg, written by extract_netatmo_stations),
+# with the dates of their first and last measures, their location and a compact
+# integer station_id. The hourly measures can then be reduced to observation
+# tables with only (station_id, time, Temperature, min_temp, max_temp), and the
+# metadata of the stations joined back only when needed (plots, exports...)
+# ----------------------------------------------------------------------
+
+STATION_COLUMNS = ['module_id', 'device_id', 'lat', 'long', 'timezone', 'country', 'altitude',
+                   'city', 'street', 'geometry']
+
+REGISTRY_COLUMNS = ['station_id', 'device_id', 'module_id', 'lat', 'long', 'timezone', 'country', 'altitude',
+                    'city', 'street', 'first_seen', 'last_seen', 'location_changes']
+
+LOCATION_COLUMNS = ['module_id', 'month', 'device_id', 'lat', 'long', 'timezone', 'country', 'altitude',
+                    'city', 'street', 'first_seen', 'last_seen']
+
+OBSERVATION_COLUMNS = ['station_id', 'time', 'Temperature', 'min_temp', 'max_temp']
+
+# ----------------------------------------------------------------------
+
+def station_key(temp_net_df):
+    # the observation tables identify the stations by station_id, the other tables by module_id
+    if 'station_id' in temp_net_df.columns:
+        return 'station_id'
+    return 'module_id'
+
+# ----------------------------------------------------------------------
+
+def locations_csv_path(registry_file):
+    # location of every station in every month, kept next to the registry (sensors_locations.csv)
+    return os.path.splitext(registry_file)[0] + '_locations.csv'
+
+# ----------------------------------------------------------------------
+
+def load_station_registry(registry_file):
+    import geopandas as gpd
+
+    if os.path.exists(registry_file):
+        registry = pd.DataFrame(gpd.read_file(registry_file))
+        registry['station_id'] = registry['station_id'].astype('int32')
+        return registry
+    return pd.DataFrame({'station_id': pd.Series(dtype='int32'), 'module_id': pd.Series(dtype=object)})
+
+# ----------------------------------------------------------------------
+
+def monthly_stations(temp_net_df):
+
+    # The stations of a month of measures: data of the first row of each module_id, last location,
+    # and dates of the first and last measures
+    columns = [column for column in LOCATION_COLUMNS if column in temp_net_df.columns]
+    stations = temp_net_df[temp_net_df['module_id'].notna()].drop_duplicates(subset = 'module_id')[columns]
+    stations = stations.set_index('module_id')
+
+    last_rows = temp_net_df.drop_duplicates(subset = 'module_id', keep = 'last').set_index('module_id')
+    stations['lat'] = last_rows['lat']
+    stations['long'] = last_rows['long']
+
+    day = temp_net_df['time'].astype(str).str[:10]
+    stations['first_seen'] = day.groupby(temp_net_df['module_id']).min()
+    stations['last_seen'] = day.groupby(temp_net_df['module_id']).max()
+
+    return stations.reset_index()
+
+# ----------------------------------------------------------------------
+
+def update_station_registry(stations, registry_file, year, month):
+    import geopandas as gpd
+
+    # Add the stations of a month to the registry of all the stations seen so far. The location of every station
+    # in every month is kept next to it (see locations_csv_path), and the registry is derived from it in the order
+    # of the months: dates of the first and last measures, data and location of the last month, and number of
+    # changes of location from a month to the next. The months can thus be added in any order, and a month added
+    # again replaces the previous one. A station keeps its station_id, the new ones take the next free ones
+    locations_file = locations_csv_path(registry_file)
+    locations = stations.assign(month='%s-%02d' % (year, month)).reindex(columns=LOCATION_COLUMNS)
+
+    if os.path.exists(locations_file):
+        # exact coordinates, as they are compared from a month to the next
+        previous = pd.read_csv(locations_file, float_precision='round_trip')
+        locations = pd.concat([previous[previous['month'] != '%s-%02d' % (year, month)], locations], ignore_index=True)
+
+    locations = locations.sort_values(['module_id', 'month']).reset_index(drop=True)
+    locations.to_csv(locations_file, index=False)
+
+    # a station moved when its location differs from the one of its previous month
+    by_station = locations.groupby('module_id', sort=False)
+    moved = (by_station.cumcount() > 0) & ((locations['lat'] != by_station['lat'].shift()) |
+                                           (locations['long'] != by_station['long'].shift()))
+
+    registry = locations.drop_duplicates(subset = 'module_id', keep = 'last').set_index('module_id')
+    registry['first_seen'] = by_station['first_seen'].min()
+    registry['last_seen'] = by_station['last_seen'].max()
+    registry['location_changes'] = moved.groupby(locations['module_id']).sum()
+
+    known_ids = load_station_registry(registry_file).set_index('module_id')['station_id']
+    registry['station_id'] = registry.index.map(known_ids)
+    is_new = registry['station_id'].isna()
+    first_id = known_ids.max() + 1 if len(known_ids) > 0 else 0
+    registry.loc[is_new, 'station_id'] = np.arange(first_id, first_id + is_new.sum())
+    registry['station_id'] = registry['station_id'].astype('int32')
+
+    registry = registry.reset_index()[REGISTRY_COLUMNS]
+    registry_gdf = gpd.GeoDataFrame(registry, geometry = gpd.points_from_xy(registry.long, registry.lat), crs = 'EPSG:4326')
+    registry_gdf.to_file(registry_file, driver = 'GPKG')
+
+    return registry_gdf
+
+# ----------------------------------------------------------------------
+
+def register_stations(temp_net_df, year, month, registry_file):
+    # Add the stations of a month of measures to the registry, and return it
+    update_station_registry(monthly_stations(temp_net_df), registry_file, year, month)
+    return load_station_registry(registry_file)
+
+# ----------------------------------------------------------------------
+
+def to_observations(temp_net_df, registry):
+
+    # Replace the module_id and the metadata of every measure by the station_id of the registry. As in the
+    # cleaning steps, only the measures taken at the first location of every station in temp_net_df are kept
+    station_id = temp_net_df['module_id'].map(registry.set_index('module_id')['station_id'])
+    kept = station_id.notna()
+
+    if {'lat', 'long'} <= set(temp_net_df.columns):
+        first_location = temp_net_df.drop_duplicates('module_id').set_index('module_id')
+        kept &= ((temp_net_df['lat'] == temp_net_df['module_id'].map(first_location['lat'])) &
+                 (temp_net_df['long'] == temp_net_df['module_id'].map(first_location['long'])))
+
+    observations = temp_net_df.loc[kept, [column for column in OBSERVATION_COLUMNS[1:] if column in temp_net_df.columns]]
+    observations.insert(0, 'station_id', station_id[kept].astype('int32'))
+
+    # timestamps instead of strings
+    if 'time' in observations.columns:
+        observations['time'] = pd.to_datetime(observations['time'], format='ISO8601')
+
+    return observations.reset_index(drop=True)
+
+# ----------------------------------------------------------------------
+
+def attach_metadata(df, registry, columns=None):
+
+    # Join the metadata of the stations (all of them, or only the given columns) to a table with station_id
+    if columns is None:
+        columns = [column for column in registry.columns if column != 'station_id']
+
+    metadata = registry.set_index('station_id')[list(columns)]
+    return df.join(metadata, on='station_id')